@@ -1,8 +1,8 @@
-import pandas as pd
+from libs.output_schema import load_output
 
 
 def analyze():
-    df = pd.read_parquet("outputs/output.parquet")
+    df = load_output().to_pandas()
     print(df)
 
 if __name__ == "__main__":
@@ -0,0 +1,334 @@
+# python -m benchmarks.class_length_benchmark [--scale 0.2] [--save-baseline]
+import os
+import sys
+import json
+import time
+import shutil
+import random
+import argparse
+import tempfile
+import subprocess
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+
+from git import Repo
+
+from libs.class_length import CHUNK_SIZE, MIN_CODE_FILES, extract_classes_length, read_file_chunks, \
+    scan_file_records, scan_repo_by_lang, scan_tree_by_lang, get_class_length_metrics, \
+    get_class_length_metrics_from_mirror
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+BASELINE_LOCATION = os.path.join(os.path.dirname(os.path.abspath(__file__)), "class_length_baseline.json")
+REGRESSION_TOLERANCE = 0.15  # slower or hungrier than the baseline by more than this is flagged
+REPEATS = 3  # the fastest repeat counts, the others only absorb noise
+SEED = 0
+SMALL_CHUNK_SIZE = 4096  # puts a piece boundary inside most classes, the parser's trickiest path
+
+# every corpus is a java tree generated from these; "files" is scaled by --scale, never below MIN_CODE_FILES
+CORPORA = {
+    "many_small_files": {"files": 3000, "classes": 1, "methods": 3, "method_lines": 4, "nesting": 0,
+                         "comment_density": 0.1, "giant_files": 0},
+    "large_files": {"files": 150, "classes": 3, "methods": 60, "method_lines": 25, "nesting": 1,
+                    "comment_density": 0.2, "giant_files": 0},
+    "deep_nesting": {"files": 500, "classes": 1, "methods": 4, "method_lines": 6, "nesting": 8,
+                     "comment_density": 0.2, "giant_files": 0},
+    "comment_heavy": {"files": 500, "classes": 2, "methods": 8, "method_lines": 8, "nesting": 1,
+                      "comment_density": 0.9, "giant_files": 0},
+    "generated": {"files": 100, "classes": 1, "methods": 5, "method_lines": 5, "nesting": 0,
+                  "comment_density": 0.1, "giant_files": 3, "giant_file_lines": 300000, "minified_files": 3},
+}
+# paths the scan must leave out; classes written there are not expected back
+DECOY_DIRECTORIES = ["target/generated-sources", "node_modules/some-package", "ignored"]
+GITIGNORE = "/ignored/\n"
+
+
+def get_comment(rng):
+    # comments and strings that look like code, which the parser must not take for classes or braces
+    return rng.choice([
+        "    // class NotAClass { is only a comment\n",
+        "    /* a block comment about class Decoy {\n       still commented } */\n",
+        "    /** Javadoc mentioning interface Foo and record Bar(int x) { */\n",
+        '    String template = "class Quoted { }";\n',
+        '    String block = """\n        enum InText { A, B }\n        """;\n',
+    ])
+
+
+def write_method(rng, lines, name, params):
+    body = [f"    public int {name}(int value) {{\n"]
+    for i in range(params["method_lines"]):
+        if rng.random() < params["comment_density"]:
+            body.append(get_comment(rng))
+        if i % 4 == 0:
+            body.append(f"        if (value > {i}) {{\n            value -= {i};\n        }}\n")
+        else:
+            body.append(f"        value = value * {i + 1} + {rng.randrange(1000)};\n")
+    body.append("        return value;\n    }\n")
+    lines.extend(body)
+
+
+def write_class(rng, lines, name, depth, params):
+    # returns the number of classes written, nested ones included
+    keyword = "class" if depth == 0 else rng.choice(["class", "static class", "interface", "enum", "record"])
+    if keyword == "enum":
+        lines.append(f"public enum {name} {{\n    FIRST, SECOND;\n")
+    elif keyword == "record":
+        lines.append(f"public record {name}(int x, int y) {{\n")
+    elif keyword == "interface":
+        lines.append(f"public interface {name} {{\n    int apply(int value);\n")
+    else:
+        lines.append(f"public {keyword} {name} extends Base implements Comparable<{name}> {{\n")
+    classes = 1
+    if rng.random() < params["comment_density"]:
+        lines.append(get_comment(rng))
+    if keyword != "interface":
+        for i in range(params["methods"]):
+            write_method(rng, lines, f"method{i}", params)
+    if depth < params["nesting"]:
+        classes += write_class(rng, lines, f"{name}Inner{depth}", depth + 1, params)
+    lines.append("}\n")
+    return classes
+
+
+def write_giant_file(location, lines_count):
+    # the shape of protobuf or parser-generator output: one class, a wall of members
+    with open(location, 'w') as giant_file:
+        giant_file.write("// Generated by the protocol buffer compiler.  DO NOT EDIT!\n")
+        giant_file.write("public final class GiantGenerated {\n")
+        for i in range(lines_count // 3):
+            giant_file.write(f"  public static final int FIELD_{i}_NUMBER = {i};\n"
+                             f"  private java.lang.String field{i}_ = \"\";\n"
+                             f"  // @@protoc_insertion_point(field:{i})\n")
+        giant_file.write("}\n")
+
+
+def write_minified_file(location, classes):
+    # everything on one line, as a minifier or an obfuscator leaves it
+    with open(location, 'w') as minified_file:
+        minified_file.write("".join(f"class M{i}{{int f(int v){{if(v>{i}){{v-={i};}}return v;}}}}"
+                                    for i in range(classes)))
+
+
+def generate_corpus(location, params, scale, seed=SEED):
+    # writes the tree and returns what a correct scan of it finds: code files, their bytes and their classes;
+    # giant generated and minified files are found but skipped by the file limits, their classes aren't expected
+    rng = random.Random(seed)
+    expected = {"files": 0, "bytes": 0, "classes": 0}
+    files = max(int(params["files"] * scale), MIN_CODE_FILES)
+    for i in range(files):
+        package = "/".join(f"pkg{rng.randrange(4)}" for _ in range(rng.randint(1, 4)))
+        directory = os.path.join(location, "src", "main", "java", "com", "example", *package.split("/"))
+        os.makedirs(directory, exist_ok=True)
+        lines = [f"package com.example.{package.replace('/', '.')};\n\n", "import java.util.List;\n\n"]
+        classes = sum(write_class(rng, lines, f"Type{i}x{j}", 0, params) for j in range(params["classes"]))
+        code_file = os.path.join(directory, f"Type{i}.java")
+        with open(code_file, 'w') as f:
+            f.write("".join(lines))
+        expected["files"] += 1
+        expected["bytes"] += os.path.getsize(code_file)
+        expected["classes"] += classes
+    for i in range(params["giant_files"]):
+        directory = os.path.join(location, "src", "generated", "java")
+        os.makedirs(directory, exist_ok=True)
+        code_file = os.path.join(directory, f"GiantGenerated{i}.java")
+        write_giant_file(code_file, int(params["giant_file_lines"] * max(scale, 0.1)))
+        expected["files"] += 1
+        expected["bytes"] += os.path.getsize(code_file)
+    for i in range(params.get("minified_files", 0)):
+        directory = os.path.join(location, "src", "main", "resources")
+        os.makedirs(directory, exist_ok=True)
+        code_file = os.path.join(directory, f"Minified{i}.java")
+        write_minified_file(code_file, 2000)
+        expected["files"] += 1
+        expected["bytes"] += os.path.getsize(code_file)
+    for decoy_directory in DECOY_DIRECTORIES:
+        directory = os.path.join(location, *decoy_directory.split("/"))
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, "Decoy.java"), 'w') as f:
+            f.write("public class Decoy {\n}\n")
+    with open(os.path.join(location, ".gitignore"), 'w') as f:
+        f.write(GITIGNORE)
+    # committed, so the modes reading the object store see the same tree
+    git = ["git", "-c", "user.name=benchmark", "-c", "user.email=benchmark@localhost", "-c", "core.autocrlf=false"]
+    subprocess.run(git + ["init", "-q"], cwd=location, check=True)
+    subprocess.run(git + ["add", "-A"], cwd=location, check=True)
+    subprocess.run(git + ["commit", "-q", "-m", "corpus"], cwd=location, check=True)
+    return expected
+
+
+def count_records(code_files, scan):
+    files, classes = 0, 0
+    for code_file in code_files:
+        files += 1
+        classes += scan(code_file)
+    return files, classes
+
+
+def run_extract(root):
+    return count_records((code_file for _, code_file, _ in scan_repo_by_lang(root)),
+                         lambda code_file: len(extract_classes_length(code_file)[0]))
+
+
+def run_small_chunks(root):
+    def scan(code_file):
+        records, _ = scan_file_records(read_file_chunks(code_file, SMALL_CHUNK_SIZE), os.path.getsize(code_file))
+        return len(records or [])
+
+    return count_records((code_file for _, code_file, _ in scan_repo_by_lang(root)), scan)
+
+
+def run_walk(root):
+    return sum(1 for _ in scan_repo_by_lang(root)), None
+
+
+def run_tree(root):
+    repo = Repo(root)
+    try:
+        return len(scan_tree_by_lang(repo)), None
+    finally:
+        repo.close()
+
+
+def run_metrics(root):
+    metrics = get_class_length_metrics(root, use_cache=False)
+    return None, len(metrics["class_full_lengths"]) if metrics else 0
+
+
+def run_mirror(root):
+    metrics = get_class_length_metrics_from_mirror(root, use_cache=False)
+    return None, len(metrics["class_full_lengths"]) if metrics else 0
+
+
+# parsers over the walk, traversals alone, and the whole measurement as the scan runs it
+MODES = {
+    "extract": run_extract,  # extract_classes_length on every file, read in CHUNK_SIZE pieces
+    "small_chunks": run_small_chunks,  # the same in SMALL_CHUNK_SIZE pieces
+    "walk": run_walk,  # scan_repo_by_lang over the working tree
+    "tree": run_tree,  # scan_tree_by_lang over HEAD's tree
+    "metrics": run_metrics,  # get_class_length_metrics, no cache
+    "mirror": run_mirror,  # get_class_length_metrics_from_mirror, no cache
+}
+
+
+def get_peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def measure_mode(mode, root):
+    # runs in a fresh process, so the peak RSS is this mode's alone
+    rss_before = get_peak_rss_mb()
+    start_time = time.perf_counter()
+    files, classes = MODES[mode](root)
+    seconds = time.perf_counter() - start_time
+    rss_after = get_peak_rss_mb()
+    return {"seconds": seconds, "files": files, "classes": classes, "peak_rss_mb": rss_after,
+            "rss_growth_mb": rss_after - rss_before if rss_after is not None else None}
+
+
+def run_mode(mode, root, expected, repeats):
+    runs = []
+    for _ in range(repeats):
+        with ProcessPoolExecutor(1, mp_context=mp.get_context("spawn")) as executor:
+            runs.append(executor.submit(measure_mode, mode, root).result())
+    best = min(runs, key=lambda run: run["seconds"])
+    rss = [run["peak_rss_mb"] for run in runs if run["peak_rss_mb"] is not None]
+    return {
+        "seconds": round(best["seconds"], 4),
+        "files_per_second": round(expected["files"] / best["seconds"], 1),
+        "mb_per_second": round(expected["bytes"] / (1024 * 1024) / best["seconds"], 3),
+        "peak_rss_mb": round(max(rss), 1) if rss else None,
+        "rss_growth_mb": round(max(run["rss_growth_mb"] for run in runs), 1) if rss else None,
+        "files": best["files"],
+        "classes": best["classes"],
+    }
+
+
+def get_flags(result, expected, baseline, tolerance):
+    flags = []
+    if result["files"] is not None and result["files"] != expected["files"]:
+        flags.append(f"found {result['files']} files, {expected['files']} expected")
+    if result["classes"] is not None and result["classes"] != expected["classes"]:
+        flags.append(f"found {result['classes']} classes, {expected['classes']} expected")
+    if baseline is None:
+        return flags
+    if result["mb_per_second"] < baseline["mb_per_second"] * (1 - tolerance):
+        flags.append(f"{1 - result['mb_per_second'] / baseline['mb_per_second']:.0%} slower than the baseline")
+    if result["peak_rss_mb"] is not None and baseline.get("peak_rss_mb") and \
+            result["peak_rss_mb"] > baseline["peak_rss_mb"] * (1 + tolerance):
+        flags.append(f"peak RSS {result['peak_rss_mb'] / baseline['peak_rss_mb'] - 1:.0%} above the baseline")
+    return flags
+
+
+def load_baseline(baseline_location, scale):
+    if not os.path.exists(baseline_location):
+        return {}
+    with open(baseline_location, 'r') as baseline_file:
+        baseline = json.load(baseline_file)
+    if baseline.get("scale") != scale or baseline.get("seed") != SEED:
+        print(f"baseline in {baseline_location} was taken at another scale, not comparing")
+        return {}
+    return baseline["results"]
+
+
+def save_baseline(baseline_location, scale, results):
+    # a baseline only means something on the machine it was taken on, it isn't committed
+    with open(baseline_location, 'w') as baseline_file:
+        json.dump({"scale": scale, "seed": SEED, "chunk_size": CHUNK_SIZE, "taken_at": time.strftime("%Y-%m-%d %H:%M"),
+                   "results": results}, baseline_file, indent=4)
+    print(f"baseline saved to {baseline_location}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Throughput and peak memory of the class length parser and the "
+                                                 "repository traversal over synthetic java trees.")
+    parser.add_argument("--corpora", nargs="+", choices=list(CORPORA), default=list(CORPORA))
+    parser.add_argument("--modes", nargs="+", choices=list(MODES), default=list(MODES))
+    parser.add_argument("--scale", type=float, default=1.0, help="multiplies the file count of every corpus")
+    parser.add_argument("--repeats", type=int, default=REPEATS)
+    parser.add_argument("--baseline", default=BASELINE_LOCATION)
+    parser.add_argument("--save-baseline", action="store_true", help="store this run as the baseline")
+    parser.add_argument("--tolerance", type=float, default=REGRESSION_TOLERANCE)
+    args = parser.parse_args(argv)
+
+    baseline = load_baseline(args.baseline, args.scale)
+    results = {}
+    flagged = 0
+    corpora_location = tempfile.mkdtemp(prefix="class_length_benchmark-")
+    try:
+        for corpus in args.corpora:
+            root = os.path.join(corpora_location, corpus)
+            start_time = time.perf_counter()
+            expected = generate_corpus(root, CORPORA[corpus], args.scale)
+            print(f"{corpus}: {expected['files']} files, {expected['bytes'] / (1024 * 1024):.1f} MB, "
+                  f"{expected['classes']} classes (generated in {time.perf_counter() - start_time:.1f}s)")
+            results[corpus] = {}
+            for mode in args.modes:
+                result = run_mode(mode, root, expected, args.repeats)
+                results[corpus][mode] = result
+                flags = get_flags(result, expected, baseline.get(corpus, {}).get(mode), args.tolerance)
+                flagged += len(flags)
+                rss = f"{result['peak_rss_mb']:.0f} MB peak RSS (+{result['rss_growth_mb']:.0f})" \
+                    if result["peak_rss_mb"] is not None else "peak RSS unknown"
+                print(f"  {mode:<13} {result['seconds']:8.3f}s {result['files_per_second']:>10,.0f} files/s "
+                      f"{result['mb_per_second']:8.2f} MB/s  {rss}" + "".join(f"\n    !! {flag}" for flag in flags))
+            shutil.rmtree(root, ignore_errors=True)
+    finally:
+        shutil.rmtree(corpora_location, ignore_errors=True)
+
+    if args.save_baseline:
+        save_baseline(args.baseline, args.scale, results)
+    if flagged:
+        print(f"{flagged} regressions flagged")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,90 @@
+# python -m benchmarks.description_benchmark
+import time
+import random
+import string
+
+from libs import description
+from libs.description import BOOK_KEYWORDS
+
+PAGES = 40
+PER_PAGE = 100
+REPEATS = 0.3  # share of descriptions already seen on an earlier page, as across overlapping searches
+
+SAMPLE_DESCRIPTIONS = [
+    "A fast, lightweight HTTP client for the JVM",
+    "Spring Boot starter for distributed tracing with OpenTelemetry",
+    "Ein einfaches Werkzeug zur Verwaltung von Konfigurationsdateien",
+    "一个基于Netty的高性能RPC框架",
+    "Learn Java the hard way - 100 exercises",
+    "Una biblioteca para procesar archivos CSV de forma eficiente",
+    "Android library providing Material Design components (v2.3)",
+    "The definitive guide to concurrency in modern Java",
+    "Простой клиент для работы с API Telegram",
+    "Reactive streams implementation with backpressure support",
+]
+
+
+def make_pages(seed=0):
+    rng = random.Random(seed)
+    seen = []
+    pages = []
+    for _ in range(PAGES):
+        page = []
+        for _ in range(PER_PAGE):
+            if seen and rng.random() < REPEATS:
+                page.append(rng.choice(seen))
+                continue
+            text = rng.choice(SAMPLE_DESCRIPTIONS) + " " + "".join(rng.choice(string.ascii_lowercase) for _ in range(6))
+            seen.append(text)
+            page.append(text)
+        pages.append(page)
+    return pages
+
+
+def legacy_is_bad(repo_description):
+    import langid
+    if langid.classify(repo_description)[0] != 'en':
+        return True
+    for char in string.punctuation + "0123456789":
+        repo_description = repo_description.replace(char, '')
+    for key_word in BOOK_KEYWORDS:
+        if key_word.upper() in repo_description.upper():
+            return True
+    return False
+
+
+def batched_is_bad(page):
+    languages = description.classify_languages(page)
+    return [language != 'en' or description.find_keyword(text, BOOK_KEYWORDS) is not None
+            for text, language in zip(page, languages)]
+
+
+def main():
+    pages = make_pages()
+    total = PAGES * PER_PAGE
+
+    start_time = time.perf_counter()
+    import langid
+    langid.classify("warm up")
+    legacy_startup = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    legacy = [[legacy_is_bad(text) for text in page] for page in pages]
+    legacy_seconds = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    description.get_language_identifier()
+    batched_startup = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    batched = [batched_is_bad(page) for page in pages]
+    batched_seconds = time.perf_counter() - start_time
+
+    disagreements = sum(a != b for legacy_page, batched_page in zip(legacy, batched)
+                        for a, b in zip(legacy_page, batched_page))
+    print(f"{total} descriptions in {PAGES} pages")
+    print(f"legacy:  startup {legacy_startup:.2f}s, {legacy_seconds:.3f}s, {total / legacy_seconds:,.0f} per second")
+    print(f"batched: startup {batched_startup:.2f}s, {batched_seconds:.3f}s, {total / batched_seconds:,.0f} per second")
+    print(f"speedup {legacy_seconds / batched_seconds:.1f}x, {disagreements} different decisions")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+# python -m benchmarks.metrics_benchmark
+import time
+
+import numpy as np
+import pyarrow as pa
+
+from libs.metrics import contribution_metrics, length_metrics
+from libs.output_schema import LENGTHS, get_list_column
+
+REPOS = 100000
+MEAN_CONTRIBUTORS = 20
+MEAN_CLASSES = 40
+UNSORTED = 0.1  # share of rows not already sorted, as in outputs written by hand or by older scans
+
+
+def make_column(rng, mean_size, descending):
+    sizes = rng.poisson(mean_size, REPOS)
+    sizes[rng.random(REPOS) < 0.02] = 0  # repos without any contributor or class
+    rows = []
+    for size in sizes:
+        row = np.sort(rng.zipf(1.6, size).clip(max=100000))
+        if descending:
+            row = row[::-1]
+        if rng.random() < UNSORTED:
+            rng.shuffle(row)
+        rows.append(row.tolist())
+    return pa.table({"column": pa.array(rows, type=LENGTHS)})
+
+
+def legacy_contribution_metrics(rows):
+    metrics = []
+    for row in rows:
+        counts = sorted(row, reverse=True)
+        total = sum(counts)
+        result = {}
+        for i in range(1, 6):
+            top_total = sum(counts[:i])
+            result[f"top_{i}_contributors_percent"] = round((top_total / total) * 100, 2) if total else 0.0
+        for i in range(1, 6):
+            result[f"{i}_time_contributors"] = counts.count(i)
+        metrics.append(result)
+    return {name: np.array([result[name] for result in metrics]) for name in metrics[0]}
+
+
+def legacy_length_metrics(rows):
+    return {
+        "mean_effective_length": np.array([sum(x) / len(x) if x else 0 for x in rows]),
+        "median_effective_length": np.array([sorted(x)[len(x) // 2] if x else 0 for x in rows]),
+        "max_effective_length": np.array([max(x) if x else 0 for x in rows]),
+    }
+
+
+def compare(legacy, vectorized):
+    # rounding a tie to 2 digits can land one cent apart between python's round and numpy's
+    return {name: float(np.max(np.abs(legacy[name] - vectorized[name]))) for name in legacy}
+
+
+def run(name, table, legacy_function, vectorized_function):
+    start_time = time.perf_counter()
+    rows = table["column"].to_pylist()
+    legacy = legacy_function(rows)
+    legacy_seconds = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    vectorized = vectorized_function(*get_list_column(table, "column"))
+    vectorized_seconds = time.perf_counter() - start_time
+
+    differences = compare(legacy, vectorized)
+    values = len(table["column"].combine_chunks().values)
+    print(f"{name}: {REPOS} repos, {values:,} values")
+    print(f"  legacy:     {legacy_seconds:.3f}s")
+    print(f"  vectorized: {vectorized_seconds:.3f}s, {legacy_seconds / vectorized_seconds:.1f}x faster")
+    print(f"  largest difference {max(differences.values())}")
+
+
+def main():
+    rng = np.random.default_rng(0)
+    run("contributors", make_column(rng, MEAN_CONTRIBUTORS, descending=True),
+        legacy_contribution_metrics, contribution_metrics)
+    run("class lengths", make_column(rng, MEAN_CLASSES, descending=False),
+        legacy_length_metrics, length_metrics)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,153 +1,166 @@
-import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
-import numpy as np
 import os
-import ast
-from scipy.stats import pearsonr, spearmanr, ttest_ind
-
-df = pd.read_parquet("outputs/output.parquet")
-
-def parse_list_column(series):
-    def parse(x):
-        if isinstance(x, str):
-            return ast.literal_eval(x)
-        elif isinstance(x, list):
-            return x
-        elif hasattr(x, "tolist"):
-            return x.tolist()
-        else:
-            return []
-    return series.apply(parse)
-
-def analyze_contributions(column_data):
-    metrics = []
-    for row in column_data:
-        counts = sorted(row, reverse=True)
-        total = sum(counts)
-        result = {}
-        for i in range(1, 6):
-            top_total = sum(counts[:i])
-            result[f"top_{i}_contributors_percent"] = round((top_total / total) * 100, 2) if total else 0.0
-        for i in range(1, 6):
-            result[f"{i}_time_contributors"] = counts.count(i)
-        metrics.append(result)
-    return pd.DataFrame(metrics)
-
-def extract_lengths(col):
-    parsed = parse_list_column(col)
-    stats = pd.DataFrame()
-    stats["mean_effective_length"] = parsed.apply(lambda x: sum(x) / len(x) if x else 0)
-    stats["median_effective_length"] = parsed.apply(lambda x: sorted(x)[len(x)//2] if x else 0)
-    stats["max_effective_length"] = parsed.apply(lambda x: max(x) if x else 0)
-    return stats
-
-contrib_lists = parse_list_column(df["contributors_distribution"])
-contrib_metrics = analyze_contributions(contrib_lists)
-length_stats = extract_lengths(df["class_effective_lengths"])
-
-df = pd.concat([df.reset_index(drop=True), contrib_metrics, length_stats], axis=1)
-
-# Define column groups
-length_cols = ["mean_effective_length", "median_effective_length", "max_effective_length"]
-top_contrib_cols = [f"top_{i}_contributors_percent" for i in range(1, 6)]
-low_contrib_cols = [f"{i}_time_contributors" for i in range(1, 6)]
-all_metrics = length_cols + top_contrib_cols + low_contrib_cols
-
-# Create output directory
-os.makedirs("analysis_outputs/plots", exist_ok=True)
-
-# Descriptive statistics
-desc_stats = df[all_metrics].describe(percentiles=[.05, .25, .5, .75, .95]).T
-desc_stats.to_excel("analysis_outputs/descriptive_statistics.xlsx")
-
-# Histograms and CDFs with mean and median lines
-for col in all_metrics:
-    mean_val = df[col].mean()
-    median_val = df[col].median()
-
-    plt.figure(figsize=(6, 4))
-    sns.histplot(df[col], bins=30, kde=False)
-    plt.axvline(mean_val, color="red", linestyle="--", label=f"Mean: {mean_val:.2f}")
-    plt.axvline(median_val, color="blue", linestyle=":", label=f"Median: {median_val:.2f}")
-    plt.title(f"Histogram of {col}")
-    plt.xlabel(col)
-    plt.ylabel("Frequency")
-    plt.legend()
-    plt.tight_layout()
-    plt.savefig(f"analysis_outputs/plots/histogram_{col}.png")
-    plt.close()
-
-    plt.figure(figsize=(6, 4))
-    sorted_vals = np.sort(df[col])
-    cdf = np.arange(1, len(sorted_vals)+1) / len(sorted_vals)
-    plt.plot(sorted_vals, cdf, label="CDF")
-    plt.axvline(mean_val, color="red", linestyle="--", label=f"Mean: {mean_val:.2f}")
-    plt.axvline(median_val, color="blue", linestyle=":", label=f"Median: {median_val:.2f}")
-    plt.title(f"CDF of {col}")
-    plt.xlabel(col)
-    plt.ylabel("Cumulative Probability")
-    plt.legend()
-    plt.tight_layout()
-    plt.savefig(f"analysis_outputs/plots/cdf_{col}.png")
-    plt.close()
-
-# LLCD plots
-for col in length_cols + [f"{i}_time_contributors" for i in range(1, 6)]:
-    plt.figure(figsize=(6, 4))
-    vals = df[col].replace(0, np.nan).dropna()
-    vals_sorted = np.sort(vals)
-    ccdf = 1.0 - np.arange(1, len(vals_sorted) + 1) / len(vals_sorted)
-    plt.loglog(vals_sorted, ccdf)
-    plt.title(f"Log-Log Complementary CDF of {col}")
-    plt.xlabel(col)
-    plt.ylabel("1 - CDF")
-    plt.tight_layout()
-    plt.savefig(f"analysis_outputs/plots/llcd_{col}.png")
-    plt.close()
-
-# Correlation analysis and scatter plots with Pearson annotation
-pearson_rows = []
-
-for l_col in length_cols:
-    for c_col in top_contrib_cols + low_contrib_cols:
-        pearson_corr, p_p = pearsonr(df[l_col], df[c_col])
-        pearson_rows.append({"Length Metric": l_col, "Contribution Metric": c_col, "Correlation": pearson_corr, "p-value": p_p})
-
-        plt.figure(figsize=(6, 4))
-        sns.regplot(x=df[l_col], y=df[c_col], scatter_kws={"s": 10}, line_kws={"color": "red"})
-        plt.title(f"{l_col} vs {c_col}")
-        plt.xlabel(l_col)
-        plt.ylabel(c_col)
-        plt.text(0.05, 0.95, f"r={pearson_corr:.4f}, p={p_p}",
-                 transform=plt.gca().transAxes, fontsize=9, verticalalignment='top',
-                 bbox=dict(facecolor='white', alpha=0.5))
-        plt.tight_layout()
-        plt.savefig(f"analysis_outputs/plots/scatter_{l_col}_vs_{c_col}.png")
-        plt.close()
-
-pd.DataFrame(pearson_rows).to_excel("analysis_outputs/pearson_correlations_annotated.xlsx", index=False)
-
-# T-test and boxplots with annotation
-df["centralized"] = df["top_1_contributors_percent"] > 80
-ttest_rows = []
-
-for l_col in length_cols:
-    centralized_vals = df[df["centralized"]][l_col]
-    non_centralized_vals = df[~df["centralized"]][l_col]
-    t_stat, p_val = ttest_ind(centralized_vals, non_centralized_vals, equal_var=False)
-    ttest_rows.append({"Length Metric": l_col, "t-stat": t_stat, "p-value": p_val})
-
-    plt.figure(figsize=(6, 4))
-    sns.boxplot(x="centralized", y=l_col, data=df)
-    plt.title(f"{l_col} by Centralization (Top1 > 80%)")
-    plt.xlabel("Centralized (>80%)")
-    plt.ylabel(l_col)
-    plt.text(0.05, 0.95, f"t={t_stat:.4f}, p={p_val}",
-             transform=plt.gca().transAxes, fontsize=9, verticalalignment='top',
-             bbox=dict(facecolor='white', alpha=0.5))
-    plt.tight_layout()
-    plt.savefig(f"analysis_outputs/plots/boxplot_{l_col}_centralized_annotated.png")
-    plt.close()
-
-pd.DataFrame(ttest_rows).to_excel("analysis_outputs/ttest_results_updated.xlsx", index=False)
+import sys
+import time
+import logging
+import argparse
+from contextlib import contextmanager
+
+# pandas, pyarrow, scipy and matplotlib are imported inside the functions that need them,
+# so importing this module for one metric doesn't pay for the whole report
+
+ANALYSIS_LOCATION = "analysis_outputs"
+PLOTS_LOCATION = os.path.join(ANALYSIS_LOCATION, "plots")
+CENTRALIZED_THRESHOLD = 80  # top contributor percent above which a repo counts as centralized
+
+LENGTH_COLUMNS = ["mean_effective_length", "median_effective_length", "max_effective_length"]
+TOP_CONTRIBUTION_COLUMNS = [f"top_{i}_contributors_percent" for i in range(1, 6)]
+LOW_CONTRIBUTION_COLUMNS = [f"{i}_time_contributors" for i in range(1, 6)]
+ALL_METRICS = LENGTH_COLUMNS + TOP_CONTRIBUTION_COLUMNS + LOW_CONTRIBUTION_COLUMNS
+LLCD_COLUMNS = LENGTH_COLUMNS + LOW_CONTRIBUTION_COLUMNS
+
+
+@contextmanager
+def phase(name, timings=None):
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start_time
+        if timings is not None:
+            timings[name] = seconds
+        logging.info(f"{name}: {seconds:.2f}s")
+
+
+def load(output_location=None, columns=None, filters=None):
+    from libs.output_schema import OUTPUT_LOCATION, load_output
+    return load_output(output_location or OUTPUT_LOCATION, columns=columns, filters=filters)
+
+
+def analyze_contributions(output):
+    # metrics are computed over the flattened list column in one pass, not repo by repo
+    import pandas as pd
+    from libs.output_schema import get_list_column
+    from libs.metrics import contribution_metrics
+    return pd.DataFrame(contribution_metrics(*get_list_column(output, "contributors_distribution")))
+
+
+def extract_lengths(output):
+    import pandas as pd
+    from libs.output_schema import get_list_column
+    from libs.metrics import length_metrics
+    return pd.DataFrame(length_metrics(*get_list_column(output, "class_effective_lengths")))
+
+
+def compute_metrics(output):
+    # one row per repo: the scanned columns next to their contribution and length metrics
+    import pandas as pd
+    df = output.to_pandas()
+    return pd.concat([df.reset_index(drop=True), analyze_contributions(output), extract_lengths(output)], axis=1)
+
+
+def describe(df):
+    return df[ALL_METRICS].describe(percentiles=[.05, .25, .5, .75, .95]).T
+
+
+def correlations(df):
+    import pandas as pd
+    from scipy.stats import pearsonr
+    pearson_rows = []
+    for l_col in LENGTH_COLUMNS:
+        for c_col in TOP_CONTRIBUTION_COLUMNS + LOW_CONTRIBUTION_COLUMNS:
+            pearson_corr, p_p = pearsonr(df[l_col], df[c_col])
+            pearson_rows.append({"Length Metric": l_col, "Contribution Metric": c_col, "Correlation": pearson_corr, "p-value": p_p})
+    return pd.DataFrame(pearson_rows)
+
+
+def get_centralized(df):
+    return df["top_1_contributors_percent"] > CENTRALIZED_THRESHOLD
+
+
+def ttests(df):
+    import pandas as pd
+    from scipy.stats import ttest_ind
+    centralized = get_centralized(df)
+    ttest_rows = []
+    for l_col in LENGTH_COLUMNS:
+        t_stat, p_val = ttest_ind(df[centralized][l_col], df[~centralized][l_col], equal_var=False)
+        ttest_rows.append({"Length Metric": l_col, "t-stat": t_stat, "p-value": p_val})
+    return pd.DataFrame(ttest_rows)
+
+
+def build_plots(df, pearson_results, ttest_results, plots_location=PLOTS_LOCATION):
+    # histograms, cdfs and llcds per metric, a scatter per correlation and a boxplot per t-test
+    columns = {col: df[col].to_numpy() for col in ALL_METRICS}
+    plots = []
+    for col in ALL_METRICS:
+        plots.append({"kind": "histogram", "location": f"{plots_location}/histogram_{col}.png",
+                      "data": {"values": columns[col]}, "params": {"column": col, "bins": 30}})
+        plots.append({"kind": "cdf", "location": f"{plots_location}/cdf_{col}.png",
+                      "data": {"values": columns[col]}, "params": {"column": col}})
+
+    for col in LLCD_COLUMNS:
+        plots.append({"kind": "llcd", "location": f"{plots_location}/llcd_{col}.png",
+                      "data": {"values": columns[col]}, "params": {"column": col}})
+
+    for l_col, c_col, pearson_corr, p_p in pearson_results.itertuples(index=False):
+        plots.append({"kind": "scatter", "location": f"{plots_location}/scatter_{l_col}_vs_{c_col}.png",
+                      "data": {"x": columns[l_col], "y": columns[c_col]},
+                      "params": {"x_column": l_col, "y_column": c_col, "annotation": f"r={pearson_corr:.4f}, p={p_p}"}})
+
+    centralized = get_centralized(df).to_numpy()
+    for l_col, t_stat, p_val in ttest_results.itertuples(index=False):
+        plots.append({"kind": "boxplot", "location": f"{plots_location}/boxplot_{l_col}_centralized_annotated.png",
+                      "data": {"groups": centralized, "values": columns[l_col]},
+                      "params": {"column": l_col, "title": f"{l_col} by Centralization (Top1 > {CENTRALIZED_THRESHOLD}%)",
+                                 "x_label": f"Centralized (>{CENTRALIZED_THRESHOLD}%)",
+                                 "annotation": f"t={t_stat:.4f}, p={p_val}"}})
+    return plots
+
+
+def render(plots, plots_location=PLOTS_LOCATION, plot_workers=None, force=False):
+    from libs.plots import PLOT_WORKERS, render_plots
+    return render_plots(plots, plots_location, plot_workers or PLOT_WORKERS, force=force)
+
+
+def run_analysis(output_location=None, analysis_location=ANALYSIS_LOCATION, plots=True, plot_workers=None,
+                 force_plots=False):
+    # the full report; returns how long each phase took
+    timings = {}
+    plots_location = os.path.join(analysis_location, "plots")
+    os.makedirs(plots_location, exist_ok=True)
+
+    with phase("load", timings):
+        output = load(output_location)
+    with phase("metrics", timings):
+        df = compute_metrics(output)
+    with phase("descriptive statistics", timings):
+        describe(df).to_excel(os.path.join(analysis_location, "descriptive_statistics.xlsx"))
+    with phase("correlations", timings):
+        pearson_results = correlations(df)
+        pearson_results.to_excel(os.path.join(analysis_location, "pearson_correlations_annotated.xlsx"), index=False)
+    with phase("t-tests", timings):
+        ttest_results = ttests(df)
+        ttest_results.to_excel(os.path.join(analysis_location, "ttest_results_updated.xlsx"), index=False)
+    if plots:
+        with phase("plots", timings):
+            render(build_plots(df, pearson_results, ttest_results, plots_location), plots_location, plot_workers,
+                   force_plots)
+    logging.info(f"analysis done in {sum(timings.values()):.2f}s")
+    return timings
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Statistics and plots over the scan output.")
+    parser.add_argument("--output", help="scan output parquet, outputs/output.parquet by default")
+    parser.add_argument("--analysis-location", default=ANALYSIS_LOCATION, help="where the tables and plots go")
+    parser.add_argument("--no-plots", action="store_true", help="only write the tables")
+    parser.add_argument("--force-plots", action="store_true", help="redraw plots even if nothing changed")
+    parser.add_argument("--plot-workers", type=int, help="processes rendering plots")
+    args = parser.parse_args(argv)
+    run_analysis(args.output, args.analysis_location, plots=not args.no_plots, plot_workers=args.plot_workers,
+                 force_plots=args.force_plots)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s - %(message)s")
+    main(sys.argv[1:])
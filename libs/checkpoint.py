@@ -0,0 +1,145 @@
+import os
+import json
+import time
+import shutil
+import logging
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from libs.instrumentation import get_repo_name
+from libs.output_schema import OUTPUT_LOCATION, ROW_GROUP_SIZE, build_output_table, conform_to_output_schema, \
+    open_output_writer, write_output_table
+
+MANIFEST_LOCATION = os.path.join("outputs", "scan_manifest.jsonl")
+PARTS_LOCATION = os.path.join("outputs", "output_parts")
+PART_SIZE = 50  # results held in memory before they are written out as a parquet part
+
+COMPLETED = "completed"
+SKIPPED = "skipped"
+FAILED = "failed"
+FINISHED_STATUSES = (COMPLETED, SKIPPED)  # failed repositories are tried again on the next run
+
+
+def load_manifest(manifest_location=MANIFEST_LOCATION):
+    # latest entry of every repository; a later run's entry overrides an earlier one
+    manifest = {}
+    if not os.path.exists(manifest_location):
+        return manifest
+    with open(manifest_location, 'r') as manifest_file:
+        for line in manifest_file:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # a line torn by a crash mid-write
+            manifest[entry["repo_url"]] = entry
+    return manifest
+
+
+def reset_checkpoint(manifest_location=MANIFEST_LOCATION, parts_location=PARTS_LOCATION, keep_gate_verdicts=True):
+    # repositories the code files gate turned away stay turned away, so they aren't cloned just to be skipped again
+    if os.path.exists(manifest_location):
+        kept_entries = [entry for entry in load_manifest(manifest_location).values()
+                        if keep_gate_verdicts and entry["status"] == SKIPPED and "gate" in entry]
+        with open(manifest_location + ".tmp", 'w') as manifest_file:
+            for entry in kept_entries:
+                manifest_file.write(json.dumps(entry) + "\n")
+        os.replace(manifest_location + ".tmp", manifest_location)
+    if os.path.exists(parts_location):
+        shutil.rmtree(parts_location)
+
+
+def open_checkpoint(manifest_location=MANIFEST_LOCATION, parts_location=PARTS_LOCATION, part_size=PART_SIZE):
+    os.makedirs(parts_location, exist_ok=True)
+    return {
+        "manifest": open(manifest_location, 'a'),
+        "parts_location": parts_location,
+        "part_size": part_size,
+        "run_id": time.strftime("%Y%m%d-%H%M%S"),
+        "part_number": 0,
+        "rows": [],
+        "repo_urls": [],
+        "counts": {COMPLETED: 0, SKIPPED: 0, FAILED: 0},
+    }
+
+
+def write_manifest_entries(checkpoint, entries):
+    manifest = checkpoint["manifest"]
+    for entry in entries:
+        manifest.write(json.dumps(entry) + "\n")
+    manifest.flush()
+    os.fsync(manifest.fileno())
+
+
+def record_result(checkpoint, repo_url, status, metrics=None):
+    # metrics of a repository that didn't complete are details of why, kept in its manifest entry
+    checkpoint["counts"][status] += 1
+    if status != COMPLETED:
+        write_manifest_entries(checkpoint, [{"repo_url": repo_url, "status": status, "part": None,
+                                             "recorded_at": time.time(), **(metrics or {})}])
+        return
+    checkpoint["rows"].append(metrics)
+    checkpoint["repo_urls"].append(repo_url)
+    if len(checkpoint["rows"]) >= checkpoint["part_size"]:
+        flush_checkpoint(checkpoint)
+
+
+def flush_checkpoint(checkpoint):
+    if not checkpoint["rows"]:
+        return
+    checkpoint["part_number"] += 1
+    part_name = f"part-{checkpoint['run_id']}-{checkpoint['part_number']:05d}.parquet"
+    part_location = os.path.join(checkpoint["parts_location"], part_name)
+    # written under a temporary name and renamed, so a crash never leaves half a part behind
+    write_output_table(build_output_table(checkpoint["rows"]), part_location + ".tmp")
+    os.replace(part_location + ".tmp", part_location)
+    # a repository only counts as done once its row is safely on disk
+    now = time.time()
+    write_manifest_entries(checkpoint, [{"repo_url": repo_url, "status": COMPLETED, "part": part_name,
+                                         "recorded_at": now} for repo_url in checkpoint["repo_urls"]])
+    logging.info(f"checkpointed {len(checkpoint['rows'])} results to {part_name}")
+    checkpoint["rows"] = []
+    checkpoint["repo_urls"] = []
+
+
+def close_checkpoint(checkpoint):
+    flush_checkpoint(checkpoint)
+    checkpoint["manifest"].close()
+    counts = checkpoint["counts"]
+    logging.info(f"this run: {counts[COMPLETED]} completed, {counts[SKIPPED]} skipped, {counts[FAILED]} failed")
+
+
+def consolidate_parts(manifest_location=MANIFEST_LOCATION, parts_location=PARTS_LOCATION,
+                      output_location=OUTPUT_LOCATION):
+    # rows are kept only from the part the manifest points at, which drops those of a repository scanned twice
+    repos_by_part = {}
+    for repo_url, entry in load_manifest(manifest_location).items():
+        if entry["status"] == COMPLETED:
+            repos_by_part.setdefault(entry["part"], set()).add(get_repo_name(repo_url))
+    part_names = sorted(part_name for part_name in repos_by_part
+                        if os.path.exists(os.path.join(parts_location, part_name)))
+    if not part_names:
+        logging.info("no results to consolidate")
+        return 0
+
+    total_rows = 0
+    pending_tables = []
+    pending_rows = 0
+    # one row group's worth of parts in memory at a time
+    with open_output_writer(output_location + ".tmp") as writer:
+        for part_name in part_names:
+            table = conform_to_output_schema(pq.read_table(os.path.join(parts_location, part_name)))
+            table = table.filter(pc.is_in(table["repo"], pa.array(sorted(repos_by_part[part_name]))))
+            pending_tables.append(table)
+            pending_rows += len(table)
+            total_rows += len(table)
+            if pending_rows >= ROW_GROUP_SIZE:
+                writer.write_table(pa.concat_tables(pending_tables), row_group_size=ROW_GROUP_SIZE)
+                pending_tables = []
+                pending_rows = 0
+        if pending_tables:
+            writer.write_table(pa.concat_tables(pending_tables), row_group_size=ROW_GROUP_SIZE)
+    os.replace(output_location + ".tmp", output_location)
+    logging.info(f"consolidated {total_rows} results from {len(part_names)} parts into {output_location}")
+    return total_rows
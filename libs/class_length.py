@@ -1,74 +1,531 @@
 import os
 import re
-from bdb import effective
+import codecs
+import string
+import time
+import logging
+from itertools import chain, islice
 
+from git import Repo
 
-def scan_repo_by_lang(current_clone_location):
-    scanned_files = []
-    for r, d, f in os.walk(current_clone_location):
-        for file_name in f:
-            if file_name.split(".")[-1] == "java":
-                scanned_files.append(os.path.join(r, file_name))
-    return scanned_files
+from libs.instrumentation import timed, count
+from libs.languages import BRACES, get_language, create_language_matcher
+from libs.traversal import iter_code_files, create_path_filter, add_rules_file, is_excluded_path
+from libs.result_cache import open_cache, get_cached_records, store_records
 
+CHUNK_SIZE = 1024 * 1024
+PARSER_VERSION = 2  # bump whenever a parser change alters the records of an unchanged file
+MIN_CODE_FILES = 50  # repositories with fewer code files than this are skipped, here and in the collector
+CACHE_LOOKUP_BATCH_SIZE = 500  # files looked up in the cache together while the walk streams them in
 
-def extract_classes_length(code_file):
+# a file the parser sees is held CHUNK_SIZE + MAX_LINE_LENGTH characters at a time, whatever its size; files
+# that aren't hand-written source are skipped, and counted per reason in the output
+MAX_FILE_BYTES = 2 * 1024 * 1024  # larger files are skipped unread, no hand-written class comes close
+MAX_LINE_LENGTH = 5000  # a longer line is minified or machine-written code
+SKIP_GENERATED = True  # skip files whose head carries one of GENERATED_MARKERS
+HEAD_SIZE = 8192  # characters at the start of a file checked for generated markers and binary content
+GENERATED_MARKERS = ["@Generated", "@javax.annotation.Generated", "@generated", "DO NOT EDIT", "<auto-generated",
+                     "Code generated by", "Autogenerated by"]
+TOO_LARGE = "too_large"
+LONG_LINES = "long_lines"
+BINARY = "binary"
+GENERATED = "generated"
+SKIP_REASONS = [TOO_LARGE, LONG_LINES, BINARY, GENERATED]
+
+CODE_LINE_PATTERN = re.compile(r'^[ \t\r\f\v]*\S', re.MULTILINE)
+IDENTIFIER_CHARS = frozenset(string.ascii_letters + string.digits + "_$.")
+# a kotlin header goes on past a line break when the next line opens with one of these
+HEADER_TOKEN_PATTERN = re.compile(r'[(){};\n]')
+HEADER_CONTINUATION_PATTERN = re.compile(r'\s*(?:[{:,.<=)]|where\b)')
+CONTINUATION = '\x00'  # starts every line that continues a multiline string, so indentation can't end a class there
+
+
+def scan_repo_by_lang(current_clone_location, languages=None, exclude_patterns=None):
+    # (language, path, size) of every code file of the given languages, all of them found in one walk
+    return iter_code_files(current_clone_location, create_language_matcher(languages), exclude_patterns)
+
+
+def scan_tree_by_lang(repo, languages=None, exclude_patterns=None):
+    # (language, blob sha, size, path) of every code file at HEAD, read from the object store without any checkout
+    match_language = create_language_matcher(languages)
+    path_filter = create_path_filter(exclude_patterns)
+    scanned_blobs = []
+    ls_tree = repo.git.ls_tree("-r", "-l", "-z", "HEAD")
+    for entry in ls_tree.split('\0'):
+        if not entry:
+            continue
+        info, path = entry.split('\t', 1)
+        mode, object_type, blob_sha, size = info.split()
+        if object_type != "blob" or mode == "120000":
+            continue
+        directory, _, file_name = path.rpartition('/')
+        if file_name in (".gitignore", ".gitattributes"):
+            add_rules_file(path_filter, directory, file_name, repo.odb.stream(bytes.fromhex(blob_sha)).read().decode(
+                'utf-8', errors='ignore'))
+        language = match_language(file_name)
+        if language is not None:
+            scanned_blobs.append((language, blob_sha, int(size), path))
+    # every rules file has to be in before a path can be judged
+    return [scanned_blob for scanned_blob in scanned_blobs if not is_excluded_path(path_filter, scanned_blob[3])]
+
+
+def get_blob_shas(current_clone_location):
+    # the index already holds the blob sha of every tracked file, no need to hash the files ourselves
+    try:
+        ls_files = Repo(current_clone_location).git.ls_files("-s", "-z")
+    except Exception:
+        return {}
+    blob_shas = {}
+    for entry in ls_files.split('\0'):
+        if entry:
+            info, path = entry.split('\t', 1)
+            blob_shas[os.path.normpath(os.path.join(current_clone_location, path))] = info.split()[1]
+    return blob_shas
+
+
+def read_file_chunks(code_file, chunk_size=CHUNK_SIZE):
     with open(code_file, 'r', encoding='utf-8', errors='ignore') as f:
-        lines = f.readlines()
-
-    class_pattern = re.compile(r'^\s*(public|protected|private)?\s*(abstract|final)?\s*class\s+(\w+)\b')
-    effective_class_lengths = []
-    full_class_lengths = []
-    in_class = False
-    in_block_comment = False
-    brace_count = 0
-    full_line_count = 0
-    effective_line_count = 0
-
-    for line in lines:
-        stripped = line.strip()
-        if not in_class:
-            match = class_pattern.match(line)
-            if match:
-                in_class = True
-                brace_count = line.count('{') - line.count('}')
-                effective_line_count, full_line_count = 1, 1
-        else:
-            full_line_count += 1
-            if in_block_comment:
-                if '*/' in stripped:
-                    in_block_comment = False
+        for chunk in iter(lambda: f.read(chunk_size), ''):
+            yield chunk
+
+
+def read_blob_chunks(repo, blob_sha, chunk_size=CHUNK_SIZE):
+    # streamed out of the repo's persistent `git cat-file --batch` process
+    stream = repo.odb.stream(bytes.fromhex(blob_sha))
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+    for chunk in iter(lambda: stream.read(chunk_size), b''):
+        yield decoder.decode(chunk)
+    yield decoder.decode(b'', final=True)
+
+
+def iter_complete_lines(chunks):
+    # re-cut the chunks on line boundaries so no token is ever split between two pieces
+    carry = ''
+    for chunk in chunks:
+        buffer = carry + chunk
+        cut = buffer.rfind('\n') + 1
+        if cut == 0:
+            carry = buffer
+            continue
+        carry = buffer[cut:]
+        yield buffer[:cut]
+    if carry:
+        yield carry + '\n'
+
+
+def blank_literals_and_comments(text, language, continuation=''):
+    # literals become a placeholder and comments disappear, keeping every newline so line numbers still line up
+    open_lexeme = None
+    text_blocks = language["text_blocks"]
+
+    def replace(match):
+        nonlocal open_lexeme
+        kind = match.lastgroup
+        if kind.startswith('string'):
+            return '""'
+        if kind == 'line_comment':
+            return ''
+        newlines = match.group().count('\n')
+        if kind.startswith('open_'):
+            open_lexeme = kind
+        if kind in text_blocks:
+            return '""' + f'\n{continuation}""' * newlines
+        return ' ' + '\n' * newlines
+
+    return language["lexeme_pattern"].sub(replace, text), open_lexeme
+
+
+def find_lexeme_end(text, open_lexeme, language):
+    # where a block comment or multiline string left open by the previous piece ends in this one, -1 if it doesn't
+    match = language["closers"][open_lexeme].match(text)
+    return match.end() if match else -1
+
+
+def count_code_lines(text, start, stop, line_has_code):
+    # lines ended inside text[start:stop], how many of them hold code, and whether the still open line does
+    first_newline = text.find('\n', start, stop)
+    if first_newline == -1:
+        return 0, 0, line_has_code or bool(text[start:stop].strip())
+    last_newline = text.rfind('\n', start, stop)
+    code_lines = 1 if line_has_code or text[start:first_newline].strip() else 0
+    code_lines += len(CODE_LINE_PATTERN.findall(text, first_newline + 1, last_newline + 1))
+    newlines = text.count('\n', first_newline, last_newline + 1)
+    return newlines, code_lines, bool(text[last_newline + 1:stop].strip())
+
+
+def find_header_end(text, start, language, paren_depth=0):
+    # "{" when the pending header opens a body, ";" when it ends without one, None when the text runs out first,
+    # along with how many of its parentheses are still open
+    if not language["newline_ends_header"]:
+        semicolon = text.find(';', start)
+        return (';' if semicolon != -1 and text.find('{', start, semicolon) == -1 else None), 0
+    # without semicolons, a header also ends on a line the next one doesn't carry on
+    if start == 0 and not paren_depth and not HEADER_CONTINUATION_PATTERN.match(text):
+        return ';', 0
+    for token in HEADER_TOKEN_PATTERN.finditer(text, start):
+        char = token.group()
+        if char == '(':
+            paren_depth += 1
+        elif char == ')':
+            paren_depth = max(paren_depth - 1, 0)
+        elif paren_depth:
+            continue
+        elif char == '{':
+            return '{', 0
+        elif char != '\n':
+            return ';', 0
+        elif token.end() == len(text):
+            break
+        elif not HEADER_CONTINUATION_PATTERN.match(text, token.end()):
+            return ';', 0
+    return None, paren_depth
+
+
+def get_previous_char(text, pos):
+    pos -= 1
+    while pos >= 0 and text[pos] in ' \t\r\n':
+        pos -= 1
+    return text[pos] if pos >= 0 else ''
+
+
+def scan_brace_records(chunks, language):
+    structure_pattern = language["structure_pattern"]
+    class_keywords = language["class_keywords"]
+    not_after = language["not_after"]
+    records = []
+    line = 1
+    code_lines = 0  # code lines finished before the current line
+    line_has_code = False
+    open_lexeme = None
+    brace_depth = 0
+    declaration = None  # (name, kind, line, code_lines) of a header still waiting for its body
+    header_parens = 0  # parentheses that header left open at the end of the previous piece
+    class_stack = []  # (name, kind, start_line, code_lines_before, brace_depth) of every open class, innermost last
+
+    for text in iter_complete_lines(chunks):
+        if open_lexeme is not None:
+            # a block comment or multiline string left open by the previous piece
+            close_end = find_lexeme_end(text, open_lexeme, language)
+            newlines = text.count('\n', 0, close_end if close_end != -1 else len(text))
+            in_text_block = open_lexeme in language["text_blocks"]
+            if in_text_block:
+                code_lines += newlines
+            elif newlines and line_has_code:
+                code_lines += 1
+            line += newlines
+            line_has_code = in_text_block
+            if close_end == -1:
                 continue
+            open_lexeme = None
+            text = text[close_end:]
 
-            if '/*' in stripped:
-                if '*/' not in stripped:
-                    in_block_comment = True
+        text, open_lexeme = blank_literals_and_comments(text, language)
+        if declaration is not None:
+            header_end, header_parens = find_header_end(text, 0, language, header_parens)
+            if header_end == ';':
+                declaration = None
+
+        pos = 0
+        for token in structure_pattern.finditer(text):
+            token_pos = token.start()
+            token_char = text[token_pos]
+            if token_char == '{':
+                brace_depth += 1
+                if declaration is None:
+                    continue
+            elif token_char == '}':
+                if not class_stack or class_stack[-1][4] != brace_depth:
+                    if brace_depth:
+                        brace_depth -= 1
+                    continue
+            elif token_pos and text[token_pos - 1] in IDENTIFIER_CHARS:
+                # `Foo.class` and names merely ending in a keyword are no declaration
+                continue
+            elif not_after and get_previous_char(text, token_pos) in not_after:
                 continue
 
-            if stripped == "" or stripped.startswith("//"):
+            newlines, new_code_lines, line_has_code = count_code_lines(text, pos, token_pos, line_has_code)
+            line += newlines
+            code_lines += new_code_lines
+            line_has_code = True
+            pos = token_pos
+            if token_char == '{':
+                class_stack.append((*declaration, brace_depth))
+                declaration = None
+            elif token_char == '}':
+                name, kind, start_line, code_lines_before, _ = class_stack.pop()
+                records.append({
+                    "name": name,
+                    "kind": kind,
+                    "depth": len(class_stack),
+                    "parent": class_stack[-1][0] if class_stack else None,
+                    "start_line": start_line,
+                    "end_line": line,
+                    "full_length": line - start_line + 1,
+                    "effective_length": code_lines + 1 - code_lines_before,
+                })
+                brace_depth -= 1
+            else:
+                header_end, header_parens = find_header_end(text, token.end(), language)
+                if header_end != ';':
+                    keyword_index = token.lastindex
+                    declaration = (token.group(keyword_index), class_keywords[keyword_index - 1], line, code_lines)
+        newlines, new_code_lines, line_has_code = count_code_lines(text, pos, len(text), line_has_code)
+        line += newlines
+        code_lines += new_code_lines
+
+    return records
+
+
+def get_indentation(source_line):
+    return len(source_line[:len(source_line) - len(source_line.lstrip(' \t'))].expandtabs(8))
+
+
+def scan_indented_records(chunks, language):
+    class_pattern = language["class_pattern"]
+    records = []
+    line = 0
+    code_lines = 0  # code lines up to and including the current line
+    last_code_line = (0, 0)  # (line, code_lines) of the latest code line, where a class closed after it ends
+    open_lexeme = None
+    bracket_depth = 0
+    continued = False  # the previous line left a bracket open or ended in a backslash
+    class_stack = []  # (name, kind, indentation, start_line, code_lines_before) of every open class, innermost last
+
+    def close_classes(indentation):
+        end_line, end_code_lines = last_code_line
+        while class_stack and class_stack[-1][2] >= indentation:
+            name, kind, _, start_line, code_lines_before = class_stack.pop()
+            records.append({
+                "name": name,
+                "kind": kind,
+                "depth": len(class_stack),
+                "parent": class_stack[-1][0] if class_stack else None,
+                "start_line": start_line,
+                "end_line": end_line,
+                "full_length": end_line - start_line + 1,
+                "effective_length": end_code_lines - code_lines_before,
+            })
+
+    for text in iter_complete_lines(chunks):
+        prefix = ''
+        if open_lexeme is not None:
+            # every line of a multiline string left open by the previous piece continues the line it started on
+            close_end = find_lexeme_end(text, open_lexeme, language)
+            if close_end == -1:
+                prefix, text = f'{CONTINUATION}""\n' * text.count('\n'), ''
+            else:
+                prefix = f'{CONTINUATION}""\n' * text.count('\n', 0, close_end) + CONTINUATION + '""'
+                text = text[close_end:]
+                open_lexeme = None
+        if text:
+            text, open_lexeme = blank_literals_and_comments(text, language, CONTINUATION)
+
+        for source_line in (prefix + text).split('\n')[:-1]:
+            line += 1
+            stripped = source_line.strip()
+            if not stripped:
                 continue
+            if not continued and source_line[0] != CONTINUATION:
+                # a logical line of its own: whatever it doesn't sit inside of is over
+                indentation = get_indentation(source_line)
+                close_classes(indentation)
+                match = class_pattern.match(source_line)
+                if match:
+                    class_stack.append((match.group(match.lastindex), "class", indentation, line, code_lines))
+            code_lines += 1
+            last_code_line = (line, code_lines)
+            bracket_depth = max(bracket_depth + sum(map(stripped.count, "([{")) - sum(map(stripped.count, ")]}")), 0)
+            continued = bracket_depth > 0 or stripped.endswith('\\')
+    close_classes(-1)
+
+    return records
+
+
+def get_head_skip_reason(head):
+    if '\0' in head:
+        return BINARY
+    if SKIP_GENERATED and any(marker in head for marker in GENERATED_MARKERS):
+        return GENERATED
+    return None
+
+
+def has_long_line(chunk, line_length):
+    # line_length characters of the chunk's first line came in the chunks before. A line longer than
+    # MAX_LINE_LENGTH covers a whole stretch of half that length, so one newline lookup per stretch finds it
+    first_newline = chunk.find('\n')
+    if line_length + (first_newline if first_newline != -1 else len(chunk)) > MAX_LINE_LENGTH:
+        return True
+    stride = MAX_LINE_LENGTH // 2
+    pos = first_newline + 1 if first_newline != -1 else len(chunk)
+    while pos < len(chunk):
+        if chunk.find('\n', pos, pos + stride) != -1:
+            pos += stride
+            continue
+        line_start = chunk.rfind('\n', 0, pos) + 1
+        line_end = chunk.find('\n', pos + stride)
+        if (line_end if line_end != -1 else len(chunk)) - line_start > MAX_LINE_LENGTH:
+            return True
+        if line_end == -1:
+            break  # the rest of the line is in the next chunk
+        pos = line_end + 1
+    return False
+
+
+def guard_chunks(chunks, file_check):
+    # passes the chunks on until the file turns out not to be hand-written source, then stops with the reason
+    # in file_check["skipped"]; a piece the parser sees never grows past CHUNK_SIZE + MAX_LINE_LENGTH
+    line_length = 0  # characters since the last newline of the chunks before
+    for i, chunk in enumerate(chunks):
+        if i == 0:
+            file_check["skipped"] = get_head_skip_reason(chunk[:HEAD_SIZE])
+        if file_check["skipped"] is None and has_long_line(chunk, line_length):
+            file_check["skipped"] = LONG_LINES
+        if file_check["skipped"] is not None:
+            return
+        last_newline = chunk.rfind('\n')
+        line_length = len(chunk) - last_newline - 1 if last_newline != -1 else line_length + len(chunk)
+        yield chunk
+
+
+def scan_file_records(chunks, size, language="java"):
+    # (records, None), or (None, why the file was skipped); chunks is only read from when the size is in bounds
+    if size > MAX_FILE_BYTES:
+        return None, TOO_LARGE
+    file_check = {"skipped": None}
+    records = scan_class_records(guard_chunks(chunks, file_check), language)
+    if file_check["skipped"] is not None:
+        return None, file_check["skipped"]
+    return records, None
+
 
-            brace_count += line.count('{') - line.count('}')
-            effective_line_count += 1
-            if brace_count == 0:
-                effective_class_lengths.append(effective_line_count)
-                full_class_lengths.append(full_line_count)
-                in_class = False
+def scan_class_records(chunks, language="java"):
+    compiled_language = get_language(language)
+    if compiled_language["blocks"] == BRACES:
+        return scan_brace_records(chunks, compiled_language)
+    return scan_indented_records(chunks, compiled_language)
 
+
+def extract_class_records(code_file, language="java"):
+    # no records at all for a file the limits skip
+    records, _ = scan_file_records(read_file_chunks(code_file), os.path.getsize(code_file), language)
+    return records or []
+
+
+def extract_classes_length(code_file, language="java"):
+    records = extract_class_records(code_file, language)
+    full_class_lengths = [record["full_length"] for record in records]
+    effective_class_lengths = [record["effective_length"] for record in records]
     return full_class_lengths, effective_class_lengths
 
 
-def get_class_length_metrics(current_clone_location):
-    matching_files = scan_repo_by_lang(current_clone_location)
-    if len(matching_files) < 50:
-        return None
+def get_parser_version(language):
+    # records are kept per language, since the same blob can sit under two extensions, and per file limits,
+    # since under tighter ones a cached file may no longer be measured at all
+    return f"{language}:{PARSER_VERSION}:{MAX_FILE_BYTES}:{MAX_LINE_LENGTH}:{int(SKIP_GENERATED)}"
+
+
+def iter_batches(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def get_batch_cached_records(cache, batch):
+    cached_records = {}
+    for language in {language for language, _, _, _ in batch}:
+        blob_shas = [blob_sha for file_language, blob_sha, _, _ in batch if file_language == language and blob_sha]
+        cached_records[language] = get_cached_records(cache, blob_shas, get_parser_version(language))
+    return cached_records
+
+
+def measure_class_lengths(code_files, use_cache=True):
+    # code_files yields (language, blob sha or None, size in bytes, zero-argument callable yielding the text in chunks);
+    # parsing starts with the first file, the cache is asked a batch of files at a time
+    cache = open_cache() if use_cache else None
     class_full_lengths, class_effective_lengths = [], []
-    for code_file in matching_files:
-        full_file_class_lengths, effective_file_class_lengths = extract_classes_length(code_file)
-        class_full_lengths.extend(full_file_class_lengths)
-        class_effective_lengths.extend(effective_file_class_lengths)
+    new_records = {}  # language -> {blob sha: records}
+    classes_by_language = {}
+    skipped_files = {reason: 0 for reason in SKIP_REASONS}
+    files_seen = 0
+    files_parsed = 0
+    bytes_read = 0
+    start_time = time.perf_counter()
+    for batch in iter_batches(code_files, CACHE_LOOKUP_BATCH_SIZE):
+        cached_records = get_batch_cached_records(cache, batch) if cache else {}
+        for language, blob_sha, size, read_chunks in batch:
+            records = cached_records.get(language, {}).get(blob_sha)
+            if records is None:
+                records, skip_reason = scan_file_records(read_chunks(), size, language)
+                if skip_reason is not None:
+                    skipped_files[skip_reason] += 1
+                    continue
+                files_parsed += 1
+                bytes_read += size
+                if blob_sha:
+                    new_records.setdefault(language, {})[blob_sha] = records
+            classes_by_language[language] = classes_by_language.get(language, 0) + len(records)
+            class_full_lengths.extend(record["full_length"] for record in records)
+            class_effective_lengths.extend(record["effective_length"] for record in records)
+        files_seen += len(batch)
+    elapsed = time.perf_counter() - start_time
+    megabytes = bytes_read / (1024 * 1024)
+    files_skipped = sum(skipped_files.values())
+    logging.info(f"parsed {files_parsed} files ({megabytes:.2f} MB) in {elapsed:.2f}s - "
+                 f"{megabytes / elapsed if elapsed else 0:.2f} MB/s, "
+                 f"{files_seen - files_parsed - files_skipped} more served from cache")
+    if files_skipped:
+        logging.info(f"skipped {files_skipped} files: " + ", ".join(
+            f"{files} {reason.replace('_', ' ')}" for reason, files in skipped_files.items() if files))
+    count("files_parsed", files_parsed)
+    count("files_skipped", files_skipped)
+    count("files_from_cache", files_seen - files_parsed - files_skipped)
+    count("bytes_read", bytes_read)
+    count("classes_found", sum(classes_by_language.values()))
+    if len(classes_by_language) > 1:
+        logging.info("classes per language: " + ", ".join(f"{language} {count}"
+                                                        for language, count in sorted(classes_by_language.items())))
+    if cache:
+        for language, records_by_blob in new_records.items():
+            store_records(cache, records_by_blob, get_parser_version(language))
+        cache.close()
 
     return {
         "class_full_lengths": sorted(class_full_lengths, reverse=True),
         "class_effective_lengths": sorted(class_effective_lengths, reverse=True),
+        **{f"skipped_{reason}_files": files for reason, files in skipped_files.items()},
     }
+
+
+def get_class_length_metrics(current_clone_location, use_cache=True, languages=None):
+    # every language in languages (SCAN_LANGUAGES by default) is measured off the same walk of the clone
+    # files reach the parser while the walk is still going; only the first MIN_CODE_FILES are found before any of
+    # them is parsed, so a repo with too few is turned away without parsing a thing
+    scanned_files = scan_repo_by_lang(current_clone_location, languages)
+    first_files = list(islice(scanned_files, MIN_CODE_FILES))
+    if len(first_files) < MIN_CODE_FILES:
+        return None
+    blob_shas = get_blob_shas(current_clone_location) if use_cache else {}
+    code_files = ((language, blob_shas.get(os.path.normpath(code_file)), size,
+                   lambda code_file=code_file: read_file_chunks(code_file))
+                  for language, code_file, size in chain(first_files, scanned_files))
+    return measure_class_lengths(code_files, use_cache)
+
+
+def get_class_length_metrics_from_mirror(mirror_location, use_cache=True, languages=None):
+    repo = Repo(mirror_location)
+    try:
+        with timed("walk"):
+            matching_blobs = scan_tree_by_lang(repo, languages)
+        if len(matching_blobs) < MIN_CODE_FILES:
+            return None
+        code_files = [(language, blob_sha, size, lambda blob_sha=blob_sha: read_blob_chunks(repo, blob_sha))
+                      for language, blob_sha, size, _ in matching_blobs]
+        return measure_class_lengths(code_files, use_cache)
+    finally:
+        repo.close()
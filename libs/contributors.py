@@ -1,13 +1,11 @@
 import os
-import json
+import re
 
-import requests
+from git import Repo
+from git.exc import InvalidGitRepositoryError, NoSuchPathError
 
-from libs.github_api import handle_repo_rate_limit
-
-
-GITHUB_TOKEN = os.environ['GITHUB_TOKEN']
-HEADERS = {"Authorization": f"token {GITHUB_TOKEN}"}
+from libs.github_client import github_get, github_get_all_pages
+from libs.instrumentation import timed
 
 
 def extract_repo_info(url):
@@ -17,31 +15,99 @@ def extract_repo_info(url):
     return None, None
 
 
+API_CONTRIBUTORS = "api"  # the contributors endpoint, a chain of paginated requests per repo
+GIT_HISTORY_CONTRIBUTORS = "git_history"  # commits reachable from HEAD of the local clone, no request at all
+CONTRIBUTORS_ENGINES = [API_CONTRIBUTORS, GIT_HISTORY_CONTRIBUTORS]
+
+# "123+login@users.noreply.github.com" and the older "login@users.noreply.github.com" both stand for the login
+NOREPLY_EMAIL = re.compile(r'^(?:\d+\+)?([^@]+)@users\.noreply\.github\.com$')
+# names too common to tell people apart, only their emails merge them with anyone
+GENERIC_AUTHOR_NAMES = frozenset(["unknown", "root", "admin", "administrator", "user", "ubuntu", "localhost",
+                                  "none", "github", "your name", "system"])
+SHORTLOG_LINE = re.compile(r'^\s*(\d+)\t(.*?)\s*<([^>]*)>\s*$')
+
+
 def get_all_contributors(owner, repo):
-    status = True
-    counter = 0
-    contributors = []
-    url = f"https://api.github.com/repos/{owner}/{repo}/contributors"
-    while status:
-        counter = counter + 1
-        params = {
-            'anon': '1',
-            'page': str(counter)
-        }
-        headers = {'Authorization': f'token {GITHUB_TOKEN}'}
-        response = requests.get(url, headers=headers, params=params)
-        if int(response.headers.get("X-RateLimit-Remaining", 1)) <= 1:
-            response = handle_repo_rate_limit(response)
-        data = json.loads(response.text)
-        contributors.extend(data)
-        if len(data) == 0:
-            status = False
-    return contributors
+    with timed("contributors_api"):
+        return github_get_all_pages(f"repos/{owner}/{repo}/contributors", {'anon': '1'})
+
+
+def has_full_history(location):
+    # a snapshot has no git metadata and a shallow clone only its last commit, neither knows who wrote the rest
+    try:
+        repo = Repo(location)
+    except (InvalidGitRepositoryError, NoSuchPathError):
+        return False
+    try:
+        return repo.git.rev_parse("--is-shallow-repository") != "true"
+    finally:
+        repo.close()
+
+
+def get_identity_keys(name, email):
+    keys = []
+    email = email.strip().lower()
+    noreply = NOREPLY_EMAIL.match(email)
+    if noreply:
+        keys.append("login:" + noreply.group(1))
+    elif '@' in email:
+        keys.append("email:" + email)
+    name = ' '.join(name.lower().split())
+    if name and name not in GENERIC_AUTHOR_NAMES:
+        keys.append("name:" + name)
+    return keys
+
+
+def merge_identities(identities):
+    # (name, email, commits) -> commits per person; identities sharing an email, a noreply login or a name are one
+    parents = {}
+
+    def find(key):
+        while parents[key] != key:
+            parents[key] = parents[parents[key]]
+            key = parents[key]
+        return key
+
+    identity_keys = []
+    for name, email, commits in identities:
+        keys = get_identity_keys(name, email) or [f"identity:{name}<{email}>"]
+        for key in keys:
+            parents.setdefault(key, key)
+        for key in keys[1:]:
+            parents[find(key)] = find(keys[0])
+        identity_keys.append((keys[0], commits))
+
+    contributions = {}
+    for key, commits in identity_keys:
+        root = find(key)
+        contributions[root] = contributions.get(root, 0) + commits
+    return contributions
+
+
+def get_local_contributors(location):
+    # git does the counting, .mailmap included; what comes back is one line per distinct name and email
+    with timed("contributors_git"):
+        repo = Repo(location)
+        try:
+            shortlog = repo.git.shortlog("-sne", "HEAD")
+        finally:
+            repo.close()
+    identities = []
+    for line in shortlog.splitlines():
+        match = SHORTLOG_LINE.match(line)
+        if match:
+            identities.append((match.group(2), match.group(3), int(match.group(1))))
+    # shaped like the api's answer, so the distribution is built the same way from either
+    return [{"login": identity, "contributions": commits}
+            for identity, commits in merge_identities(identities).items()]
+
+
+REPO_METADATA_FIELDS = ["main_lang", "license_type", "owner_type", "count_forks", "count_stars", "count_watches"]
 
 
 def get_repo_metadata(owner, repo):
-    url = f"https://api.github.com/repos/{owner}/{repo}"
-    response = requests.get(url, headers=HEADERS)
+    with timed("metadata_api"):
+        response = github_get(f"repos/{owner}/{repo}")
     if response.status_code != 200:
         print(f"Error fetching metadata for {owner}/{repo}: {response.status_code}")
         return {}
@@ -60,25 +126,55 @@ def get_repo_metadata(owner, repo):
     return metadata
 
 
+CONTRIBUTING_GUIDANCE_FILES = [
+    'CONTRIBUTING.md',
+    'CODE_OF_CONDUCT.md',
+    '.github/CONTRIBUTING.md',
+    '.github/CODE_OF_CONDUCT.md'
+]
+README_KEYWORDS = [
+    'contribute', 'contributing', 'how to contribute', 'developer setup'
+]
+
+
 def get_contribution_friendly_metrics(repo_path):
-    files_to_check = [
-        'CONTRIBUTING.md',
-        'CODE_OF_CONDUCT.md',
-        os.path.join('.github', 'CONTRIBUTING.md'),
-        os.path.join('.github', 'CODE_OF_CONDUCT.md')
-    ]
-
-    contributing_guidance_file = any(os.path.isfile(os.path.join(repo_path, file)) for file in files_to_check)
-
-    readme_keywords = [
-        'contribute', 'contributing', 'how to contribute', 'developer setup'
-    ]
+    contributing_guidance_file = any(os.path.isfile(os.path.join(repo_path, *file.split('/')))
+                                     for file in CONTRIBUTING_GUIDANCE_FILES)
+
     readme_path = os.path.join(repo_path, 'README.md')
     readme_mentions_contributing = False
     if os.path.isfile(readme_path):
         with open(readme_path, 'r', encoding='utf-8', errors='ignore') as f:
             text = f.read().lower()
-            readme_mentions_contributing = any(keyword in text for keyword in readme_keywords)
+            readme_mentions_contributing = any(keyword in text for keyword in README_KEYWORDS)
+
+    return {
+        "contributing_guidance_file": contributing_guidance_file,
+        "readme_mentions_contributing": readme_mentions_contributing
+    }
+
+
+def get_contribution_friendly_metrics_from_mirror(mirror_location):
+    repo = Repo(mirror_location)
+    try:
+        tree = repo.head.commit.tree
+
+        def find_blob(path):
+            try:
+                item = tree / path
+            except KeyError:
+                return None
+            return item if item.type == 'blob' else None
+
+        contributing_guidance_file = any(find_blob(file) is not None for file in CONTRIBUTING_GUIDANCE_FILES)
+
+        readme = find_blob('README.md')
+        readme_mentions_contributing = False
+        if readme is not None:
+            text = readme.data_stream.read().decode('utf-8', errors='ignore').lower()
+            readme_mentions_contributing = any(keyword in text for keyword in README_KEYWORDS)
+    finally:
+        repo.close()
 
     return {
         "contributing_guidance_file": contributing_guidance_file,
@@ -86,25 +182,40 @@ def get_contribution_friendly_metrics(repo_path):
     }
 
 
-def get_repo_contributors_distribution(url, current_clone_location):
+def get_repo_contributors_distribution(url, current_clone_location, is_mirror=False, repo_metadata=None,
+                                       engine=API_CONTRIBUTORS):
     owner, repo = extract_repo_info(url)
     if not (owner and repo):
         return []
 
-    contributors = get_all_contributors(owner, repo)
+    # shallow clones and snapshots hold no history to count, so the api answers for them whatever the engine
+    if engine == GIT_HISTORY_CONTRIBUTORS and not has_full_history(current_clone_location):
+        engine = API_CONTRIBUTORS
+    if engine == GIT_HISTORY_CONTRIBUTORS:
+        contributors = get_local_contributors(current_clone_location)
+    else:
+        contributors = get_all_contributors(owner, repo)
     if not contributors:
         return []
 
     distribution = sorted([c.get('contributions', 0) for c in contributors], reverse=True)
     total_contributions = sum(distribution)
 
-    metadata = get_repo_metadata(owner, repo)
-    contribution_friendly_metrics = get_contribution_friendly_metrics(current_clone_location)
+    if repo_metadata is not None:
+        # already fetched in a graphql batch, see libs/github_graphql.py
+        metadata = {field: repo_metadata[field] for field in REPO_METADATA_FIELDS}
+    else:
+        metadata = get_repo_metadata(owner, repo)
+    if is_mirror:
+        contribution_friendly_metrics = get_contribution_friendly_metrics_from_mirror(current_clone_location)
+    else:
+        contribution_friendly_metrics = get_contribution_friendly_metrics(current_clone_location)
 
     record = {
         "repo": f"{owner}/{repo}",
         **metadata,
         **contribution_friendly_metrics,
+        "contributors_engine": engine,
         "total_contributors": len(contributors),
         "total_contributions": total_contributions,
         "contributors_distribution": distribution
@@ -0,0 +1,60 @@
+import re
+import string
+
+BOOK_KEYWORDS = ["learn", "learning", "tutorial", "tutorials", "book", "books", "guide", "guides", "Example",
+                 "Examples", "Introduction", "Introductions", "Course", "Courses", "Getting Started"]
+LANGUAGE_CACHE_SIZE = 100000
+# the same characters the description used to be stripped of one str.replace at a time
+DESCRIPTION_CLEANUP_TABLE = str.maketrans('', '', string.punctuation + "0123456789")
+
+language_identifier = None
+language_cache = {}  # description -> language, filled a search page at a time
+keyword_patterns = {}
+
+
+def get_language_identifier():
+    # importing langid and unpacking its model takes longer than classifying a whole search page, so only on first use
+    global language_identifier
+    if language_identifier is None:
+        from langid import langid
+        language_identifier = langid.LanguageIdentifier.from_modelstring(langid.model)
+    return language_identifier
+
+
+def classify_languages(descriptions):
+    # one matrix product for every description not seen before, instead of one model pass each
+    missing = list(dict.fromkeys(description for description in descriptions if description not in language_cache))
+    if missing:
+        import numpy as np
+        identifier = get_language_identifier()
+        features = np.stack([identifier.instance2fv(description) for description in missing])
+        class_scores = np.dot(features, identifier.nb_ptc) + identifier.nb_pc
+        if len(language_cache) + len(missing) > LANGUAGE_CACHE_SIZE:
+            language_cache.clear()
+        for description, best_class in zip(missing, class_scores.argmax(axis=1)):
+            language_cache[description] = str(identifier.nb_classes[best_class])
+    return [language_cache[description] for description in descriptions]
+
+
+def classify_language(description):
+    return classify_languages([description])[0]
+
+
+def get_keywords_pattern(keywords):
+    # the pattern, and the keyword each match stands for, keyed by its lowercased text
+    keywords = tuple(keywords)
+    if keywords not in keyword_patterns:
+        # longest first, so the reported keyword is the most specific one that matched
+        keyword_patterns[keywords] = (
+            re.compile('|'.join(re.escape(keyword) for keyword in sorted(keywords, key=len, reverse=True)),
+                       re.IGNORECASE),
+            {keyword.lower(): keyword for keyword in reversed(keywords)})
+    return keyword_patterns[keywords]
+
+
+def find_keyword(description, keywords):
+    # keywords match anywhere in the description once punctuation and digits are gone, case aside; the keyword is
+    # returned as it is listed, not as the description spells it
+    pattern, keywords_by_text = get_keywords_pattern(keywords)
+    match = pattern.search(description.translate(DESCRIPTION_CLEANUP_TABLE))
+    return keywords_by_text[match.group().lower()] if match else None
@@ -0,0 +1,86 @@
+import os
+import time
+import logging
+
+from git import Repo
+
+from libs.cloner import BASE_CLONE_LOCATION, get_clone_url, get_git_auth_env, generate_random_key, \
+    delete_currently_cloned_repository
+from libs.class_length import MIN_CODE_FILES
+from libs.languages import SCAN_LANGUAGES, create_language_matcher
+from libs.mirrors import find_local_mirror
+from libs.traversal import create_path_filter, is_excluded_path
+
+
+def get_gate_verdict(code_files, languages=None, min_code_files=MIN_CODE_FILES):
+    return {"code_files": code_files, "min_code_files": min_code_files, "languages": list(languages or SCAN_LANGUAGES)}
+
+
+def passes_gate(verdict):
+    return verdict["code_files"] >= verdict["min_code_files"]
+
+
+def is_current_verdict(verdict, languages=None, min_code_files=MIN_CODE_FILES):
+    # a verdict recorded under another threshold or other languages says nothing about this run
+    return verdict["min_code_files"] == min_code_files and verdict["languages"] == list(languages or SCAN_LANGUAGES)
+
+
+def count_tree_code_files(repo, languages=None):
+    match_language = create_language_matcher(languages)
+    path_filter = create_path_filter()
+    code_files = 0
+    for entry in repo.git.ls_tree("-r", "-z", "HEAD").split('\0'):
+        if not entry:
+            continue
+        info, path = entry.split('\t', 1)
+        mode, object_type, _ = info.split()
+        if object_type == "blob" and mode != "120000" and match_language(path.rsplit("/", 1)[-1]) is not None \
+                and not is_excluded_path(path_filter, path):
+            code_files += 1
+    return code_files
+
+
+def count_remote_code_files(repo_url, languages=None):
+    # a bare, one commit deep clone without blobs carries nothing but the trees of the default branch
+    tree_location = os.path.join(BASE_CLONE_LOCATION, f"tree-{generate_random_key()}")
+    try:
+        repo = Repo.clone_from(get_clone_url(repo_url), tree_location, env=get_git_auth_env(),
+                               multi_options=["--bare", "--depth=1", "--filter=blob:none"])
+        try:
+            return count_tree_code_files(repo, languages)
+        finally:
+            repo.close()
+    finally:
+        delete_currently_cloned_repository(tree_location)
+
+
+def log_verdict(repo_url, verdict, start_time):
+    logging.info(f"{'/'.join(repo_url.split('/')[-2:])} has {verdict['code_files']} code files "
+                 f"({'passes' if passes_gate(verdict) else 'fails'} the gate), "
+                 f"counted in {time.perf_counter() - start_time:.2f}s")
+    return verdict
+
+
+def get_verdict_from_repo(location, repo_url, languages=None, min_code_files=MIN_CODE_FILES):
+    # counted off a clone or mirror that is fetched anyway, before anything of it is checked out
+    start_time = time.perf_counter()
+    repo = Repo(location)
+    try:
+        code_files = count_tree_code_files(repo, languages)
+    finally:
+        repo.close()
+    return log_verdict(repo_url, get_gate_verdict(code_files, languages, min_code_files), start_time)
+
+
+def check_code_files_gate(repo_url, languages=None, min_code_files=MIN_CODE_FILES):
+    # the file count both the collector and the scanner hold repositories to, taken from the tree alone: no checkout,
+    # no parsing and no search api. It can only overestimate what the scan ends up parsing (.gitignore and
+    # .gitattributes rules aren't read), so a repository it rejects would have been skipped after its clone anyway.
+    # A mirror we already have answers for free, anything else costs one treeless clone - which is why the scanner
+    # doesn't come here, but asks get_verdict_from_repo about the clone or mirror it fetches
+    mirror_location = find_local_mirror(repo_url)
+    if mirror_location is not None:
+        return get_verdict_from_repo(mirror_location, repo_url, languages, min_code_files)
+    start_time = time.perf_counter()
+    code_files = count_remote_code_files(repo_url, languages)
+    return log_verdict(repo_url, get_gate_verdict(code_files, languages, min_code_files), start_time)
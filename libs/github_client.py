@@ -0,0 +1,277 @@
+import os
+import time
+import random
+import logging
+import tempfile
+import threading
+import multiprocessing as mp
+from contextlib import contextmanager
+from urllib.parse import urlparse, parse_qs
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from libs.instrumentation import timed, count, get_current_repo, repo_scope
+from libs.http_cache import open_http_cache, get_cache_key, get_cached_response, is_fresh, get_conditional_headers, \
+    store_response, mark_revalidated, mark_used, build_response
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+GITHUB_TOKEN = os.environ['GITHUB_TOKEN']
+# point the client at a local stub server by setting GITHUB_API_URL
+GITHUB_API_URL = os.environ.get('GITHUB_API_URL', "https://api.github.com").rstrip("/")
+
+CONNECTION_POOL_SIZE = 16
+PAGINATION_WORKERS = 4
+USE_HTTP_CACHE = True  # keep responses on disk between runs, see libs/http_cache.py for how long
+MAX_RATE_LIMIT_RETRIES = 5
+RESET_JITTER_SECONDS = 5  # spread the workers woken by a reset instead of waking them all at once
+
+RATE_LIMIT_RESOURCES = ["core", "search", "code_search", "graphql"]
+
+thread_state = threading.local()
+rate_limiter = None
+# a file lock is only held by one thread of a process at a time, the threads queue up on this first
+file_lock_guard = threading.Lock()
+lock_files = {}  # lock file location -> this process's open handle on it
+
+
+def create_rate_limiter(shared=False, context=mp):
+    # per resource: requests left, epoch the window resets at (0 while unknown), window limit
+    initial_state = [0.0, 0.0, 0.0] * len(RATE_LIMIT_RESOURCES)
+    if shared:
+        state = context.Array('d', initial_state, lock=False)
+        if fcntl is not None:
+            # the kernel lets go of a file lock when its holder dies, so a worker killed while updating the budget
+            # can't leave every other worker waiting on it forever the way a multiprocessing lock would
+            lock_descriptor, lock_location = tempfile.mkstemp(prefix="rate_limit-", suffix=".lock")
+            os.close(lock_descriptor)
+            return {"lock_location": lock_location, "state": state}
+        return {"lock": context.Lock(), "state": state}
+    return {"lock": threading.Lock(), "state": initial_state}
+
+
+def create_shared_rate_limiter(context=mp):
+    # handed to every pool worker through use_rate_limiter, so they all draw from one budget; a multiprocessing
+    # lock has to come from the same context the workers are started with
+    return create_rate_limiter(shared=True, context=context)
+
+
+def delete_shared_rate_limiter(limiter):
+    if "lock_location" in limiter and os.path.exists(limiter["lock_location"]):
+        os.remove(limiter["lock_location"])
+
+
+@contextmanager
+def locked(limiter):
+    if "lock_location" not in limiter:
+        with limiter["lock"]:
+            yield
+        return
+    with file_lock_guard:
+        lock_file = lock_files.get(limiter["lock_location"])
+        if lock_file is None:
+            lock_file = lock_files[limiter["lock_location"]] = open(limiter["lock_location"], 'a')
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def use_rate_limiter(limiter):
+    global rate_limiter
+    rate_limiter = limiter
+
+
+def get_rate_limiter():
+    global rate_limiter
+    if rate_limiter is None:
+        rate_limiter = create_rate_limiter()
+    return rate_limiter
+
+
+def get_resource(url):
+    path = urlparse(url).path
+    if path.startswith("/search/code"):
+        return "code_search"
+    if path.startswith("/search/"):
+        return "search"
+    if path.startswith("/graphql"):
+        return "graphql"
+    return "core"
+
+
+def acquire_rate_limit(resource):
+    limiter = get_rate_limiter()
+    index = RATE_LIMIT_RESOURCES.index(resource) * 3
+    while True:
+        with locked(limiter):
+            state = limiter["state"]
+            tokens, reset_at = state[index], state[index + 1]
+            now = time.time()
+            if now >= reset_at:
+                # nothing is known about the current window until a response reports on it
+                state[index + 1] = 0
+                return
+            if tokens >= 1:
+                state[index] = tokens - 1
+                return
+            wait = reset_at - now
+        logging.info(f"{resource} rate limit exhausted, waiting {wait:.0f} seconds for reset")
+        with timed("rate_limit_sleep"):
+            time.sleep(wait + random.uniform(1, RESET_JITTER_SECONDS))
+
+
+def update_rate_limit(response, resource):
+    try:
+        resource = response.headers.get("X-RateLimit-Resource", resource)
+        remaining = int(response.headers["X-RateLimit-Remaining"])
+        reset_at = int(response.headers["X-RateLimit-Reset"])
+        limit = int(response.headers["X-RateLimit-Limit"])
+    except (KeyError, ValueError):
+        return
+    if resource not in RATE_LIMIT_RESOURCES or reset_at <= time.time():
+        return  # a late answer from a window that already ended
+    limiter = get_rate_limiter()
+    index = RATE_LIMIT_RESOURCES.index(resource) * 3
+    with locked(limiter):
+        state = limiter["state"]
+        if reset_at > state[index + 1]:
+            state[index] = remaining
+        else:
+            # requests still in flight were already taken off the local count
+            state[index] = min(state[index], remaining)
+        state[index + 1] = reset_at
+        state[index + 2] = limit
+
+
+def block_rate_limit(resource, reset_at):
+    limiter = get_rate_limiter()
+    index = RATE_LIMIT_RESOURCES.index(resource) * 3
+    with locked(limiter):
+        # the rejected response's reset time is authoritative, whatever the local estimate said
+        limiter["state"][index] = 0
+        limiter["state"][index + 1] = reset_at
+
+
+def get_session():
+    # one keep-alive session per thread; requests sessions are not safe to share between threads
+    session = getattr(thread_state, "session", None)
+    if session is None:
+        session = requests.Session()
+        session.headers.update({"Authorization": f"token {GITHUB_TOKEN}", "Accept": "application/vnd.github+json"})
+        retry = Retry(total=3, backoff_factor=1, status_forcelist=[502, 503, 504],
+                      allowed_methods=["GET", "POST"], respect_retry_after_header=False)
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=CONNECTION_POOL_SIZE, max_retries=retry)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        thread_state.session = session
+    return session
+
+
+def api_url(path):
+    if path.startswith("http://") or path.startswith("https://"):
+        return path
+    return f"{GITHUB_API_URL}/{path.lstrip('/')}"
+
+
+def get_http_cache():
+    # one connection per thread, sqlite connections can't be shared between threads
+    connection = getattr(thread_state, "http_cache", None)
+    if connection is None:
+        connection = open_http_cache()
+        thread_state.http_cache = connection
+    return connection
+
+
+def is_rate_limited(response):
+    return response.status_code == 429 or (response.status_code == 403 and (
+        "Retry-After" in response.headers or response.headers.get("X-RateLimit-Remaining") == "0"))
+
+
+def github_request(method, path, params=None, json=None, stream=False):
+    url = api_url(path)
+    resource = get_resource(url)
+    # only plain reads are cached; streamed bodies can't be kept around
+    cache = get_http_cache() if USE_HTTP_CACHE and method == "GET" and not stream else None
+    cache_key = get_cache_key(url, params)
+    cached = get_cached_response(cache, cache_key) if cache else None
+    if cached and is_fresh(cached, url):
+        mark_used(cache, cache_key)
+        count("http_cache_hits")
+        return build_response(cached, url)
+
+    for _ in range(MAX_RATE_LIMIT_RETRIES):
+        acquire_rate_limit(resource)
+        count("http_requests")
+        response = get_session().request(method, url, params=params, json=json, stream=stream,
+                                         headers=get_conditional_headers(cached))
+        update_rate_limit(response, resource)
+        if response.status_code == 304 and cached:
+            mark_revalidated(cache, cache_key)
+            return build_response(cached, url)
+        if not is_rate_limited(response):
+            if cache:
+                store_response(cache, cache_key, response)
+            return response
+        response.close()
+        if "Retry-After" in response.headers:
+            # secondary rate limit, it names its own wait
+            retry_after = int(response.headers["Retry-After"])
+            logging.info(f"Reached Github secondary rate limit. waiting {retry_after} seconds")
+            with timed("rate_limit_sleep"):
+                time.sleep(retry_after + random.uniform(0, RESET_JITTER_SECONDS))
+        else:
+            block_rate_limit(resource, int(response.headers.get("X-RateLimit-Reset", time.time() + 60)))
+    return response
+
+
+def github_get(path, params=None, stream=False):
+    return github_request("GET", path, params=params, stream=stream)
+
+
+def github_post(path, json):
+    return github_request("POST", path, json=json)
+
+
+def github_get_json(path, params=None):
+    response = github_get(path, params)
+    response.raise_for_status()
+    return response.json()
+
+
+def get_last_page(response):
+    last_url = response.links.get("last", {}).get("url")
+    if not last_url:
+        return 1
+    return int(parse_qs(urlparse(last_url).query).get("page", ["1"])[0])
+
+
+def github_get_all_pages(path, params=None):
+    params = {"per_page": "100", **(params or {})}
+    first_page = github_get(path, {**params, "page": "1"})
+    first_page.raise_for_status()
+    if first_page.status_code == 204:  # e.g. the contributors of an empty repository
+        return []
+    items = list(first_page.json())
+    last_page = get_last_page(first_page)
+    if last_page == 1:
+        return items
+
+    # the Link header names the last page up front, so every other page can be fetched at once
+    repo = get_current_repo()
+
+    def get_page(page):
+        with repo_scope(repo):
+            return github_get_json(path, {**params, "page": str(page)})
+
+    with ThreadPoolExecutor(min(PAGINATION_WORKERS, last_page - 1)) as executor:
+        for page_items in executor.map(get_page, range(2, last_page + 1)):
+            items.extend(page_items)
+    return items
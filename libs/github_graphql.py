@@ -0,0 +1,90 @@
+import os
+import json
+import hashlib
+import logging
+
+from libs.github_client import github_post
+
+GRAPHQL_BATCH_SIZE = 50  # repositories per query; a query this size costs a single rate-limit point
+# record every query and its answer into GITHUB_GRAPHQL_FIXTURES, or replay them from there without the network
+GRAPHQL_FIXTURES = os.environ.get("GITHUB_GRAPHQL_FIXTURES")
+GRAPHQL_FIXTURE_MODE = os.environ.get("GITHUB_GRAPHQL_FIXTURE_MODE")  # "record" or "replay"
+
+REPOSITORY_FIELDS = """
+    nameWithOwner
+    stargazerCount
+    forkCount
+    watchers { totalCount }
+    licenseInfo { spdxId }
+    owner { __typename }
+    isFork
+    diskUsage
+    description
+    primaryLanguage { name }
+    defaultBranchRef { target { ... on Commit { committedDate } } }
+"""
+
+
+def build_repositories_query(full_names):
+    # one aliased repository() per repo, so a single round trip answers for the whole batch
+    aliases = []
+    for i, full_name in enumerate(full_names):
+        owner, name = full_name.split("/", 1)
+        aliases.append(f"r{i}: repository(owner: {json.dumps(owner)}, name: {json.dumps(name)}) {{{REPOSITORY_FIELDS}}}")
+    return "query {\n" + "\n".join(aliases) + "\nrateLimit { cost remaining resetAt }\n}"
+
+
+def get_fixture_location(query):
+    return os.path.join(GRAPHQL_FIXTURES, hashlib.sha1(query.encode()).hexdigest() + ".json")
+
+
+def run_query(query):
+    if GRAPHQL_FIXTURES and GRAPHQL_FIXTURE_MODE == "replay":
+        with open(get_fixture_location(query), 'r') as fixture:
+            return json.load(fixture)
+
+    response = github_post("graphql", {"query": query})
+    response.raise_for_status()
+    result = response.json()
+
+    if GRAPHQL_FIXTURES and GRAPHQL_FIXTURE_MODE == "record":
+        os.makedirs(GRAPHQL_FIXTURES, exist_ok=True)
+        with open(get_fixture_location(query), 'w') as fixture:
+            json.dump(result, fixture, indent=1)
+    return result
+
+
+def parse_repository(node):
+    target = (node.get("defaultBranchRef") or {}).get("target") or {}
+    return {
+        "main_lang": (node.get("primaryLanguage") or {}).get("name"),
+        "license_type": node["licenseInfo"]["spdxId"] if node.get("licenseInfo") else "NO_LICENSE",
+        "owner_type": node["owner"]["__typename"],  # "User" or "Organization"
+        "count_forks": node["forkCount"],
+        "count_stars": node["stargazerCount"],
+        "count_watches": node["watchers"]["totalCount"],
+        "is_fork": node["isFork"],
+        "disk_usage_kb": node.get("diskUsage"),
+        "description": node.get("description"),
+        "last_commit_date": target.get("committedDate"),
+    }
+
+
+def fetch_repos_metadata(full_names, batch_size=GRAPHQL_BATCH_SIZE):
+    # {full name: metadata} for every repository github could answer for; missing ones are left out
+    repos_metadata = {}
+    full_names = list(dict.fromkeys(full_names))
+    for i in range(0, len(full_names), batch_size):
+        batch = full_names[i:i + batch_size]
+        result = run_query(build_repositories_query(batch))
+        for error in result.get("errors", []):
+            logging.info(f"graphql: {error.get('message')}")
+        data = result.get("data") or {}
+        for alias, full_name in enumerate(batch):
+            node = data.get(f"r{alias}")
+            if node is not None:
+                repos_metadata[full_name] = parse_repository(node)
+        rate_limit = data.get("rateLimit") or {}
+        logging.info(f"fetched metadata of {len(batch)} repositories in one query "
+                     f"(cost {rate_limit.get('cost')}, {rate_limit.get('remaining')} points left)")
+    return repos_metadata
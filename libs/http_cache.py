@@ -0,0 +1,120 @@
+import os
+import re
+import sys
+import json
+import time
+import sqlite3
+from urllib.parse import urlparse, urlencode
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+try: # macOS
+    HTTP_CACHE_LOCATION = os.path.join(os.path.dirname(sys.modules['__main__'].__file__), "cache", "http.sqlite")
+except: # Windows
+    HTTP_CACHE_LOCATION = os.path.join(os.getcwd(), "cache", "http.sqlite")
+
+HOUR = 60 * 60
+DAY = 24 * HOUR
+# (endpoint path pattern, seconds a stored response is used without asking github at all); after that
+# it's revalidated with a conditional request, which costs nothing against the rate limit when answered with 304
+ENDPOINT_TTLS = [
+    (re.compile(r'^/search/code'), 7 * DAY),
+    (re.compile(r'^/search/'), HOUR),
+    (re.compile(r'^/repos/[^/]+/[^/]+/contributors'), 7 * DAY),
+    (re.compile(r'^/repos/[^/]+/[^/]+/commits'), DAY),
+    (re.compile(r'^/repos/[^/]+/[^/]+$'), DAY),
+]
+DEFAULT_TTL = 0  # always revalidate
+MAX_IDLE_SECONDS = 30 * DAY  # responses nobody asked for in this long are dropped
+CACHEABLE_STATUSES = (200, 204)
+KEPT_HEADERS = ["ETag", "Last-Modified", "Link", "Content-Type"]
+
+
+def open_http_cache(cache_location=HTTP_CACHE_LOCATION):
+    os.makedirs(os.path.dirname(cache_location), exist_ok=True)
+    # every thread and pool worker opens its own connection; WAL lets them read while one of them writes
+    connection = sqlite3.connect(cache_location, timeout=60)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS http_responses (
+            cache_key TEXT PRIMARY KEY,
+            status INTEGER NOT NULL,
+            headers TEXT NOT NULL,
+            body BLOB NOT NULL,
+            fetched_at REAL NOT NULL,
+            last_used REAL NOT NULL
+        )
+    """)
+    connection.execute("DELETE FROM http_responses WHERE last_used < ?", (time.time() - MAX_IDLE_SECONDS,))
+    connection.commit()
+    return connection
+
+
+def get_cache_key(url, params):
+    if not params:
+        return url
+    return f"{url}?{urlencode(sorted(params.items()))}"
+
+
+def get_ttl(url):
+    path = urlparse(url).path
+    for pattern, ttl in ENDPOINT_TTLS:
+        if pattern.match(path):
+            return ttl
+    return DEFAULT_TTL
+
+
+def get_cached_response(connection, cache_key):
+    row = connection.execute("SELECT status, headers, body, fetched_at FROM http_responses WHERE cache_key = ?",
+                             (cache_key,)).fetchone()
+    if row is None:
+        return None
+    status, headers, body, fetched_at = row
+    return {"status": status, "headers": json.loads(headers), "body": body, "fetched_at": fetched_at}
+
+
+def is_fresh(cached, url):
+    return time.time() - cached["fetched_at"] < get_ttl(url)
+
+
+def get_conditional_headers(cached):
+    headers = {}
+    if cached and "ETag" in cached["headers"]:
+        headers["If-None-Match"] = cached["headers"]["ETag"]
+    if cached and "Last-Modified" in cached["headers"]:
+        headers["If-Modified-Since"] = cached["headers"]["Last-Modified"]
+    return headers
+
+
+def store_response(connection, cache_key, response):
+    if response.status_code not in CACHEABLE_STATUSES:
+        return
+    now = time.time()
+    headers = {name: response.headers[name] for name in KEPT_HEADERS if name in response.headers}
+    connection.execute("INSERT OR REPLACE INTO http_responses VALUES (?, ?, ?, ?, ?, ?)",
+                       (cache_key, response.status_code, json.dumps(headers), response.content, now, now))
+    connection.commit()
+
+
+def mark_revalidated(connection, cache_key):
+    now = time.time()
+    connection.execute("UPDATE http_responses SET fetched_at = ?, last_used = ? WHERE cache_key = ?",
+                       (now, now, cache_key))
+    connection.commit()
+
+
+def mark_used(connection, cache_key):
+    connection.execute("UPDATE http_responses SET last_used = ? WHERE cache_key = ?", (time.time(), cache_key))
+    connection.commit()
+
+
+def build_response(cached, url):
+    # enough of a requests.Response for every caller: status, headers, links, json() and raise_for_status()
+    response = requests.Response()
+    response.status_code = cached["status"]
+    response.headers = CaseInsensitiveDict(cached["headers"])
+    response._content = cached["body"]
+    response.encoding = "utf-8"
+    response.url = url
+    return response
@@ -0,0 +1,203 @@
+import os
+import csv
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+REPORTS_LOCATION = os.path.join("outputs", "run_reports")
+WRITE_PROMETHEUS = False  # also leave a <run>.prom file behind for node_exporter's textfile collector
+PROMETHEUS_PREFIX = "class_length"
+PROFILE_REPOS = []  # "owner/name" of repositories whose parse is profiled, e.g. ["apache/commons-lang"]
+CPROFILE = "cprofile"
+PYINSTRUMENT = "pyinstrument"  # optional, pip install pyinstrument
+PROFILER = CPROFILE
+
+# every process keeps its own timings and counts; workers hand theirs over with take_recorded and the main
+# process adds them up with merge_recorded. Threads share their process's, tagged with the repo they work on
+recorded_lock = threading.Lock()
+thread_state = threading.local()
+recorded = {"timers": {}, "counters": {}, "repos": {}}
+run = {"name": None, "run_id": None, "started_at": None}
+
+
+def get_repo_name(repo_url):
+    return "/".join(repo_url.split("/")[-2:])
+
+
+def start_run(name):
+    run["name"] = name
+    run["run_id"] = time.strftime("%Y%m%d-%H%M%S")
+    run["started_at"] = time.perf_counter()
+
+
+def get_current_repo():
+    return getattr(thread_state, "repo", None)
+
+
+@contextmanager
+def repo_scope(repo_url):
+    # whatever this thread times or counts inside is also put down to the repository
+    previous = get_current_repo()
+    thread_state.repo = get_repo_name(repo_url) if repo_url else None
+    try:
+        yield
+    finally:
+        thread_state.repo = previous
+
+
+def add_time(stage, seconds):
+    repo = get_current_repo()
+    with recorded_lock:
+        timer = recorded["timers"].setdefault(stage, {"calls": 0, "seconds": 0.0, "max_seconds": 0.0})
+        timer["calls"] += 1
+        timer["seconds"] += seconds
+        timer["max_seconds"] = max(timer["max_seconds"], seconds)
+        if repo is not None:
+            repo_entry = recorded["repos"].setdefault(repo, {})
+            repo_entry[f"{stage}_seconds"] = repo_entry.get(f"{stage}_seconds", 0.0) + seconds
+
+
+@contextmanager
+def timed(stage):
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_time(stage, time.perf_counter() - start_time)
+
+
+def count(counter, amount=1):
+    repo = get_current_repo()
+    with recorded_lock:
+        recorded["counters"][counter] = recorded["counters"].get(counter, 0) + amount
+        if repo is not None:
+            repo_entry = recorded["repos"].setdefault(repo, {})
+            repo_entry[counter] = repo_entry.get(counter, 0) + amount
+
+
+def take_recorded():
+    # everything recorded in this process since the last call, small enough to travel back with a result
+    with recorded_lock:
+        taken = {key: dict(value) for key, value in recorded.items()}
+        for value in recorded.values():
+            value.clear()
+    return taken
+
+
+def merge_recorded(other):
+    if not other:
+        return
+    with recorded_lock:
+        for stage, other_timer in other["timers"].items():
+            timer = recorded["timers"].setdefault(stage, {"calls": 0, "seconds": 0.0, "max_seconds": 0.0})
+            timer["calls"] += other_timer["calls"]
+            timer["seconds"] += other_timer["seconds"]
+            timer["max_seconds"] = max(timer["max_seconds"], other_timer["max_seconds"])
+        for counter, amount in other["counters"].items():
+            recorded["counters"][counter] = recorded["counters"].get(counter, 0) + amount
+        for repo, other_entry in other["repos"].items():
+            repo_entry = recorded["repos"].setdefault(repo, {})
+            for key, value in other_entry.items():
+                repo_entry[key] = repo_entry.get(key, 0) + value
+
+
+def build_run_report(extra=None):
+    elapsed = time.perf_counter() - run["started_at"] if run["started_at"] is not None else 0.0
+    with recorded_lock:
+        stages = {stage: {
+            "calls": timer["calls"],
+            "seconds": round(timer["seconds"], 3),
+            "mean_seconds": round(timer["seconds"] / timer["calls"], 3) if timer["calls"] else 0.0,
+            "max_seconds": round(timer["max_seconds"], 3),
+            # summed over every worker, so with many of them this goes well past 1
+            "share_of_run": round(timer["seconds"] / elapsed, 3) if elapsed else 0.0,
+        } for stage, timer in sorted(recorded["timers"].items(), key=lambda item: -item[1]["seconds"])}
+        counters = dict(sorted(recorded["counters"].items()))
+        repos = {repo: dict(entry) for repo, entry in recorded["repos"].items()}
+    return {
+        "run": run["name"],
+        "run_id": run["run_id"],
+        "elapsed_seconds": round(elapsed, 3),
+        "repos": len(repos),
+        "stages": stages,
+        "counters": counters,
+        **(extra or {}),
+    }, repos
+
+
+def write_repos_csv(repos, location):
+    columns = sorted({column for entry in repos.values() for column in entry})
+    with open(location, 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(["repo", *columns])
+        for repo, entry in sorted(repos.items()):
+            writer.writerow([repo, *(round(entry[column], 3) if column in entry else "" for column in columns)])
+
+
+def get_prometheus_text(report):
+    labels = f'run="{report["run"]}"'
+    lines = [f"# TYPE {PROMETHEUS_PREFIX}_run_seconds gauge",
+             f"{PROMETHEUS_PREFIX}_run_seconds{{{labels}}} {report['elapsed_seconds']}",
+             f"# TYPE {PROMETHEUS_PREFIX}_stage_seconds_total counter"]
+    lines.extend(f'{PROMETHEUS_PREFIX}_stage_seconds_total{{{labels},stage="{stage}"}} {timer["seconds"]}'
+                 for stage, timer in report["stages"].items())
+    lines.append(f"# TYPE {PROMETHEUS_PREFIX}_stage_calls_total counter")
+    lines.extend(f'{PROMETHEUS_PREFIX}_stage_calls_total{{{labels},stage="{stage}"}} {timer["calls"]}'
+                 for stage, timer in report["stages"].items())
+    lines.append(f"# TYPE {PROMETHEUS_PREFIX}_events_total counter")
+    lines.extend(f'{PROMETHEUS_PREFIX}_events_total{{{labels},counter="{counter}"}} {amount}'
+                 for counter, amount in report["counters"].items())
+    return "\n".join(lines) + "\n"
+
+
+def write_run_report(extra=None, reports_location=REPORTS_LOCATION):
+    # <run id>-<run>.json holds the totals, <run id>-<run>-repos.csv a row of timings and counts per repository
+    report, repos = build_run_report(extra)
+    os.makedirs(reports_location, exist_ok=True)
+    report_name = f"{report['run_id']}-{report['run']}"
+    with open(os.path.join(reports_location, f"{report_name}.json"), 'w') as report_file:
+        json.dump(report, report_file, indent=4)
+    write_repos_csv(repos, os.path.join(reports_location, f"{report_name}-repos.csv"))
+    if WRITE_PROMETHEUS:
+        # a fixed name the collector keeps reading, swapped in whole so it never sees half a file
+        prometheus_location = os.path.join(reports_location, f"{report['run']}.prom")
+        with open(prometheus_location + ".tmp", 'w') as prometheus_file:
+            prometheus_file.write(get_prometheus_text(report))
+        os.replace(prometheus_location + ".tmp", prometheus_location)
+    logging.info(f"{report['run']} run took {report['elapsed_seconds']:.0f}s: " + ", ".join(
+        f"{stage} {timer['seconds']:.0f}s" for stage, timer in report["stages"].items()))
+    return report
+
+
+@contextmanager
+def profiled(repo_url, reports_location=REPORTS_LOCATION):
+    # only the repositories named in PROFILE_REPOS pay for a profiler
+    repo = get_repo_name(repo_url)
+    if repo not in PROFILE_REPOS:
+        yield
+        return
+    os.makedirs(reports_location, exist_ok=True)
+    profile_location = os.path.join(reports_location, f"profile-{repo.replace('/', '-')}")
+    if PROFILER == PYINSTRUMENT:
+        from pyinstrument import Profiler
+        profiler = Profiler()
+        profiler.start()
+        try:
+            yield
+        finally:
+            profiler.stop()
+            with open(profile_location + ".html", 'w') as profile_file:
+                profile_file.write(profiler.output_html())
+            logging.info(f"profile of {repo} written to {profile_location}.html")
+    else:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(profile_location + ".prof")
+            logging.info(f"profile of {repo} written to {profile_location}.prof")
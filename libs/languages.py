@@ -0,0 +1,175 @@
+import re
+import fnmatch
+
+BRACES = "braces"  # a class body is everything between its header's "{" and the matching "}"
+INDENTATION = "indentation"  # a class body is every following line indented deeper than its header
+
+# one entry per language the scanner understands; multiline strings are (opener, closer, escape), escape being
+# "\\" for backslash escapes, "double" for a doubled closer, or None
+LANGUAGES = {
+    "java": {
+        "github_name": "Java",
+        "globs": ["*.java"],
+        "class_keywords": ["class", "interface", "enum", "record"],
+        "line_comment": "//",
+        "block_comment": ("/*", "*/"),
+        "quotes": ['"', "'"],
+        "multiline_strings": [('"""', '"""', "\\")],
+        "blocks": BRACES,
+    },
+    "kotlin": {
+        "github_name": "Kotlin",
+        "globs": ["*.kt", "*.kts"],
+        "class_keywords": ["class", "interface", "object"],
+        "line_comment": "//",
+        "block_comment": ("/*", "*/"),
+        "quotes": ['"', "'"],
+        "multiline_strings": [('"""', '"""', None)],
+        "blocks": BRACES,
+        "newline_ends_header": True,  # `data class Point(val x: Int)` has neither a body nor a semicolon
+    },
+    "csharp": {
+        "github_name": "C#",
+        "globs": ["*.cs"],
+        "class_keywords": ["class", "interface", "struct", "enum", "record"],
+        "line_comment": "//",
+        "block_comment": ("/*", "*/"),
+        "quotes": ['"', "'"],
+        "multiline_strings": [('"""', '"""', None), ('@"', '"', "double")],
+        "blocks": BRACES,
+    },
+    "cpp": {
+        "github_name": "C++",
+        "globs": ["*.cpp", "*.cc", "*.cxx", "*.hpp", "*.hh", "*.hxx", "*.h"],
+        "class_keywords": ["class", "struct", "union"],
+        "line_comment": "//",
+        "block_comment": ("/*", "*/"),
+        "quotes": ['"', "'"],
+        "multiline_strings": [('R"(', ')"', None)],
+        "blocks": BRACES,
+        "not_after": "<,(",  # `template <class T>` and `f(struct stat *s)` declare no class
+    },
+    "typescript": {
+        "github_name": "TypeScript",
+        "globs": ["*.ts", "*.tsx", "*.mts", "*.cts"],
+        "class_keywords": ["class", "interface", "enum"],
+        "line_comment": "//",
+        "block_comment": ("/*", "*/"),
+        "quotes": ['"', "'"],
+        "multiline_strings": [("`", "`", "\\")],
+        "blocks": BRACES,
+    },
+    "python": {
+        "github_name": "Python",
+        "globs": ["*.py", "*.pyi"],
+        "class_keywords": ["class"],
+        "line_comment": "#",
+        "block_comment": None,
+        "quotes": ['"', "'"],
+        "multiline_strings": [('"""', '"""', "\\"), ("'''", "'''", "\\")],
+        "blocks": INDENTATION,
+    },
+}
+SCAN_LANGUAGES = ["java"]  # languages measured in every scanned repo, read in the same pass over its files
+
+compiled_languages = {}
+
+
+def get_language(name):
+    if name not in compiled_languages:
+        compiled_languages[name] = compile_language(name, LANGUAGES[name])
+    return compiled_languages[name]
+
+
+def get_language_by_github_name(github_name):
+    for name, language in LANGUAGES.items():
+        if language["github_name"].lower() == github_name.lower():
+            return name
+    raise KeyError(github_name)
+
+
+def get_string_body(closer, escape):
+    # whatever may sit between opener and closer: anything but the closer, and escaped or doubled closers
+    first, rest = re.escape(closer[0]), re.escape(closer[1:])
+    excluded = first + (r'\\' if escape == "\\" else '')
+    alternatives = [f'[^{excluded}]']
+    if escape == "\\":
+        alternatives.append(r'\\.')
+    if escape == "double":
+        alternatives.append(first + first)
+    if rest:
+        alternatives.append(f'{first}(?!{rest})')
+    return f"(?:{'|'.join(alternatives)})*"
+
+
+def compile_language(name, language):
+    # literals and comments in one lexical pass; whichever starts first wins, so a "//" inside a string is not a comment
+    lexemes = []
+    closers = {}  # open group -> pattern matching the rest of the lexeme from the start of the next piece
+    text_blocks = set()
+    openers = []
+    for i, (opener, closer, escape) in enumerate(sorted(language["multiline_strings"], key=lambda s: -len(s[0]))):
+        body = get_string_body(closer, escape)
+        lexemes.append(f"(?P<text_block{i}>{re.escape(opener)}{body}{re.escape(closer)})")
+        lexemes.append(f"(?P<open_text_block{i}>{re.escape(opener)}[\\s\\S]*)")
+        closers[f"open_text_block{i}"] = re.compile(body + re.escape(closer))
+        text_blocks.update([f"text_block{i}", f"open_text_block{i}"])
+        openers.append(opener)
+    for i, quote in enumerate(language["quotes"]):
+        q = re.escape(quote)
+        lexemes.append(f"(?P<string{i}>{q}[^{q}\\\\\\n]*(?:\\\\.[^{q}\\\\\\n]*)*{q}?)")
+        openers.append(quote)
+    lexemes.append(f"(?P<line_comment>{re.escape(language['line_comment'])}[^\\n]*)")
+    openers.append(language["line_comment"])
+    if language["block_comment"]:
+        opener, closer = language["block_comment"]
+        body = get_string_body(closer, None)
+        lexemes.append(f"(?P<block_comment>{re.escape(opener)}{body}{re.escape(closer)})")
+        lexemes.append(f"(?P<open_block_comment>{re.escape(opener)}[\\s\\S]*)")
+        closers["open_block_comment"] = re.compile(body + re.escape(closer))
+        openers.append(opener)
+    first_chars = ''.join(sorted({re.escape(opener[0]) for opener in openers}))
+
+    keywords = language["class_keywords"]
+    # one group per keyword rather than a shared one keeps the pattern on the regex engine's fast path
+    keyword_pattern = '|'.join(rf'\b{keyword}\b[ \t]*([\w$]+)' if language["blocks"] == INDENTATION
+                               else rf'{keyword}\b\s*([\w$]+)' for keyword in keywords)
+    return {
+        "name": name,
+        "blocks": language["blocks"],
+        "class_keywords": keywords,
+        "lexeme_pattern": re.compile(f"(?=[{first_chars}])(?:{'|'.join(lexemes)})"),
+        "closers": closers,
+        "text_blocks": text_blocks,
+        "structure_pattern": re.compile(r'\{|\}|' + keyword_pattern),
+        "class_pattern": re.compile(rf'[ \t]*(?:{keyword_pattern})'),
+        "newline_ends_header": language.get("newline_ends_header", False),
+        "not_after": frozenset(language.get("not_after", "")),
+        "globs": language["globs"],
+    }
+
+
+def get_globs(names=None):
+    return [glob for name in (names or SCAN_LANGUAGES) for glob in LANGUAGES[name]["globs"]]
+
+
+def create_language_matcher(names=None):
+    # file name -> language name or None; plain "*.ext" globs become one dict lookup on the extension
+    extensions = {}
+    other_globs = []
+    for name in (names or SCAN_LANGUAGES):
+        for glob in LANGUAGES[name]["globs"]:
+            if glob.startswith("*.") and not any(char in glob[2:] for char in "*?[."):
+                extensions.setdefault(glob[2:], name)
+            else:
+                other_globs.append((glob, name))
+
+    def match_language(file_name):
+        language = extensions.get(file_name.rsplit(".", 1)[-1]) if "." in file_name else None
+        if language is None:
+            for glob, name in other_globs:
+                if fnmatch.fnmatchcase(file_name, glob):
+                    return name
+        return language
+
+    return match_language
@@ -0,0 +1,74 @@
+import numpy as np
+
+TOP_CONTRIBUTORS = 5  # top_1 .. top_5 contributors percent
+FEW_TIME_CONTRIBUTIONS = 5  # 1 .. 5 time contributors
+
+# every function here takes a list column flattened by output_schema.get_list_column into (offsets, values),
+# row i holding values[offsets[i]:offsets[i + 1]], so the work is a few passes over one array however many rows
+
+
+def get_row_ids(offsets):
+    return np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+
+
+def sort_segments(offsets, values, descending=False):
+    values = np.asarray(values, dtype=np.int64)
+    if len(values) == 0:
+        return values
+    row_ids = get_row_ids(offsets)
+    steps = np.diff(values)[row_ids[1:] == row_ids[:-1]]
+    # the scanner writes its lists already sorted, so usually there's nothing left to do
+    if not np.any(steps > 0 if descending else steps < 0):
+        return values
+    # a single flat sort of (row, value) packed into one integer key rather than a sort per row
+    shifted = values - values.min()
+    span = int(shifted.max()) + 1
+    keys = row_ids * span + (span - 1 - shifted if descending else shifted)
+    return values[np.argsort(keys, kind="stable")]
+
+
+def get_segment_sums(offsets, values):
+    cumulative = np.concatenate([[0], np.cumsum(values, dtype=np.int64)])
+    return cumulative, cumulative[offsets[1:]] - cumulative[offsets[:-1]]
+
+
+def contribution_metrics(offsets, values, top_contributors=TOP_CONTRIBUTORS,
+                         few_time_contributions=FEW_TIME_CONTRIBUTIONS):
+    # {column: array with one entry per row}, the same numbers the per-repo loop used to produce
+    offsets = np.asarray(offsets, dtype=np.int64)
+    counts = sort_segments(offsets, values, descending=True)
+    starts, ends = offsets[:-1], offsets[1:]
+    cumulative, totals = get_segment_sums(offsets, counts)
+    safe_totals = np.where(totals > 0, totals, 1)
+
+    metrics = {}
+    for i in range(1, top_contributors + 1):
+        # the top i of a row are the first i of its sorted segment, read off the running sum
+        top_totals = cumulative[np.minimum(starts + i, ends)] - cumulative[starts]
+        metrics[f"top_{i}_contributors_percent"] = np.where(totals > 0, np.round(top_totals / safe_totals * 100, 2), 0.0)
+
+    rows = len(starts)
+    row_ids = get_row_ids(offsets)
+    few = (counts >= 1) & (counts <= few_time_contributions)
+    # one bincount over (row, count) pairs fills every k time contributors column at once
+    few_counts = np.bincount(row_ids[few] * few_time_contributions + counts[few] - 1,
+                             minlength=rows * few_time_contributions).reshape(rows, few_time_contributions)
+    for i in range(1, few_time_contributions + 1):
+        metrics[f"{i}_time_contributors"] = few_counts[:, i - 1]
+    return metrics
+
+
+def length_metrics(offsets, values, prefix="effective"):
+    offsets = np.asarray(offsets, dtype=np.int64)
+    lengths = sort_segments(offsets, values)
+    starts, ends = offsets[:-1], offsets[1:]
+    sizes = ends - starts
+    _, totals = get_segment_sums(offsets, lengths)
+    non_empty = sizes > 0
+    # empty rows read a dummy slot, then get masked to 0 like the old `if x else 0`
+    padded = np.concatenate([lengths, [0]])
+    return {
+        f"mean_{prefix}_length": np.where(non_empty, totals / np.where(non_empty, sizes, 1), 0.0),
+        f"median_{prefix}_length": np.where(non_empty, padded[np.where(non_empty, starts + sizes // 2, -1)], 0),
+        f"max_{prefix}_length": np.where(non_empty, padded[np.where(non_empty, ends - 1, -1)], 0),
+    }
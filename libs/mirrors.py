@@ -0,0 +1,217 @@
+import os
+import sys
+import time
+import shutil
+import logging
+import subprocess
+
+from git import Repo
+
+from libs.cloner import get_clone_url, get_git_auth_env, get_directory_size, remove_readonly
+
+try: # macOS
+    MIRRORS_LOCATION = os.path.join(os.path.dirname(sys.modules['__main__'].__file__), "mirrors")
+except: # Windows
+    MIRRORS_LOCATION = os.path.join(os.getcwd(), "mirrors")
+
+MIRRORS_QUOTA_BYTES = 200 * 1024 ** 3
+MIRROR_MAX_AGE_SECONDS = 6 * 60 * 60  # a mirror fetched more recently than this is used as is
+LOCK_POLL_SECONDS = 1
+# a lock whose owner can't be told (no pid in it yet, or on Windows) is taken for a dead worker's once this old
+STALE_LOCK_SECONDS = 2 * 60 * 60
+# branches only: a --mirror clone of a github repository also carries the head and merge ref of every pull request
+BRANCHES_REFSPEC = "+refs/heads/*:refs/heads/*"
+
+LAST_USED_STAMP = "last_used"
+LAST_FETCHED_STAMP = "last_fetched"
+
+
+def get_mirror_location(repo_url):
+    creator = repo_url.split("/")[-2]
+    project_name = repo_url.split("/")[-1]
+    return os.path.join(MIRRORS_LOCATION, creator, f"{project_name}.git")
+
+
+def find_local_mirror(repo_url):
+    mirror_location = get_mirror_location(repo_url)
+    if os.path.isdir(mirror_location):
+        return mirror_location
+    return None
+
+
+def get_stamp_age(mirror_location, stamp):
+    try:
+        return time.time() - os.path.getmtime(os.path.join(mirror_location, stamp))
+    except OSError:
+        return None
+
+
+def touch_stamp(mirror_location, stamp):
+    with open(os.path.join(mirror_location, stamp), 'w'):
+        pass
+
+
+def is_process_alive(pid):
+    if os.name == "nt":
+        return True  # signal 0 would terminate it on Windows
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def get_lock_owner(lock_location):
+    try:
+        with open(lock_location, 'r') as lock_file:
+            return int(lock_file.read())
+    except (OSError, ValueError):
+        return None
+
+
+def is_stale_lock(lock_location):
+    # the lock of a worker killed mid-fetch is freed as soon as it's found, not after STALE_LOCK_SECONDS
+    owner = get_lock_owner(lock_location)
+    if owner is not None and not is_process_alive(owner):
+        return True
+    return time.time() - os.path.getmtime(lock_location) > STALE_LOCK_SECONDS
+
+
+def acquire_lock(lock_location):
+    # O_EXCL creation is atomic on every platform, so exactly one worker wins the lock
+    while True:
+        try:
+            lock_descriptor = os.open(lock_location, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            os.write(lock_descriptor, str(os.getpid()).encode())
+            os.close(lock_descriptor)
+            return
+        except FileExistsError:
+            try:
+                if is_stale_lock(lock_location):
+                    os.remove(lock_location)
+                    continue
+            except OSError:
+                continue
+            time.sleep(LOCK_POLL_SECONDS)
+
+
+def release_lock(lock_location):
+    if os.path.exists(lock_location):
+        os.remove(lock_location)
+
+
+def is_locked(mirror_location):
+    return os.path.exists(f"{mirror_location}.lock")
+
+
+def release_mirror_lock(repo_url, owner_pid):
+    # for the scheduler, once a worker has been killed: only a lock that worker took is let go, never one another
+    # process (a duplicate of the repository, a second scan) still holds
+    lock_location = f"{get_mirror_location(repo_url)}.lock"
+    if get_lock_owner(lock_location) == owner_pid:
+        release_lock(lock_location)
+
+
+def restrict_to_branches(repo):
+    # mirrors made before BRANCHES_REFSPEC still fetch every ref; stop that and drop the pull request refs they hold
+    if repo.git.config("--get-all", "remote.origin.fetch", with_exceptions=False) == BRANCHES_REFSPEC:
+        return
+    repo.git.config("--replace-all", "remote.origin.fetch", BRANCHES_REFSPEC)
+    repo.git.config("remote.origin.mirror", "false")
+    pull_refs = repo.git.for_each_ref("--format=delete %(refname)", "refs/pull")
+    if pull_refs:
+        subprocess.run(["git", "update-ref", "--stdin"], cwd=repo.git_dir, input=pull_refs + "\n", text=True,
+                       check=True)
+
+
+def create_mirror(repo_url, mirror_location):
+    repo = Repo.clone_from(get_clone_url(repo_url), mirror_location, env=get_git_auth_env(), bare=True)
+    try:
+        repo.git.config("remote.origin.fetch", BRANCHES_REFSPEC)
+    finally:
+        repo.close()
+
+
+def update_mirror(repo_url):
+    mirror_location = get_mirror_location(repo_url)
+    creator = repo_url.split("/")[-2]
+    project_name = repo_url.split("/")[-1]
+    lock_location = f"{mirror_location}.lock"
+    os.makedirs(os.path.dirname(mirror_location), exist_ok=True)
+
+    acquire_lock(lock_location)
+    try:
+        start_time = time.perf_counter()
+        bytes_transferred = 0
+        if os.path.isdir(mirror_location):
+            last_fetched = get_stamp_age(mirror_location, LAST_FETCHED_STAMP)
+            # whoever held the lock before us may have just fetched this very repository
+            if last_fetched is None or last_fetched > MIRROR_MAX_AGE_SECONDS:
+                size_before = get_directory_size(os.path.join(mirror_location, "objects"))
+                repo = Repo(mirror_location)
+                try:
+                    # mirrors made before the token moved out of the url still have it in their config
+                    repo.git.remote("set-url", "origin", get_clone_url(repo_url))
+                    restrict_to_branches(repo)
+                    repo.git.fetch("--prune", "origin", env=get_git_auth_env())
+                finally:
+                    repo.close()
+                bytes_transferred = get_directory_size(os.path.join(mirror_location, "objects")) - size_before
+                touch_stamp(mirror_location, LAST_FETCHED_STAMP)
+        else:
+            try:
+                create_mirror(repo_url, mirror_location)
+            except Exception:
+                if os.path.exists(mirror_location):
+                    shutil.rmtree(mirror_location, onerror=remove_readonly)
+                raise
+            bytes_transferred = get_directory_size(os.path.join(mirror_location, "objects"))
+            touch_stamp(mirror_location, LAST_FETCHED_STAMP)
+        touch_stamp(mirror_location, LAST_USED_STAMP)
+    finally:
+        release_lock(lock_location)
+
+    mirror_stats = {
+        "clone_strategy": "mirror",
+        "clone_seconds": round(time.perf_counter() - start_time, 3),
+        "clone_bytes": max(bytes_transferred, 0),
+    }
+    logging.info(f"updated mirror of {creator}/{project_name} in {mirror_stats['clone_seconds']:.2f}s, "
+                 f"{mirror_stats['clone_bytes'] / (1024 * 1024):.2f} MB transferred")
+    return mirror_location, mirror_stats
+
+
+def list_mirrors():
+    mirrors = []
+    if not os.path.isdir(MIRRORS_LOCATION):
+        return mirrors
+    for creator in os.listdir(MIRRORS_LOCATION):
+        creator_location = os.path.join(MIRRORS_LOCATION, creator)
+        if not os.path.isdir(creator_location):
+            continue
+        for project in os.listdir(creator_location):
+            mirror_location = os.path.join(creator_location, project)
+            if project.endswith(".git") and os.path.isdir(mirror_location):
+                mirrors.append(mirror_location)
+    return mirrors
+
+
+def enforce_mirrors_quota(quota_bytes=MIRRORS_QUOTA_BYTES):
+    mirrors = []
+    for mirror_location in list_mirrors():
+        last_used = get_stamp_age(mirror_location, LAST_USED_STAMP)
+        mirrors.append((last_used if last_used is not None else float("inf"), mirror_location,
+                        get_directory_size(mirror_location)))
+    total_size = sum(size for _, _, size in mirrors)
+    # least recently used first
+    for _, mirror_location, size in sorted(mirrors, reverse=True):
+        if total_size <= quota_bytes:
+            break
+        if is_locked(mirror_location):
+            continue
+        logging.info(f"evicting mirror {mirror_location} ({size / (1024 ** 3):.2f} GB)")
+        shutil.rmtree(mirror_location, onerror=remove_readonly)
+        total_size -= size
+    logging.info(f"mirrors take {total_size / (1024 ** 3):.2f} GB of the {quota_bytes / (1024 ** 3):.0f} GB quota")
@@ -0,0 +1,78 @@
+import os
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+OUTPUT_LOCATION = os.path.join("outputs", "output.parquet")
+COMPRESSION = "zstd"
+ROW_GROUP_SIZE = 1000  # repositories per row group; smaller groups let filters skip more of the file
+
+# low-cardinality strings are stored once per row group and referenced by index
+CATEGORY = pa.dictionary(pa.int32(), pa.string())
+LENGTHS = pa.list_(pa.int32())
+
+OUTPUT_SCHEMA = pa.schema([
+    ("repo", pa.string()),
+    ("main_lang", CATEGORY),
+    ("license_type", CATEGORY),
+    ("owner_type", CATEGORY),
+    ("count_forks", pa.int64()),
+    ("count_stars", pa.int64()),
+    ("count_watches", pa.int64()),
+    ("contributing_guidance_file", pa.bool_()),
+    ("readme_mentions_contributing", pa.bool_()),
+    # who counted the contributors: the api or the local git history, see libs/contributors.py
+    ("contributors_engine", CATEGORY),
+    ("total_contributors", pa.int64()),
+    ("total_contributions", pa.int64()),
+    ("contributors_distribution", LENGTHS),
+    ("class_full_lengths", LENGTHS),
+    ("class_effective_lengths", LENGTHS),
+    # code files left out of the class lengths, see the file limits in libs/class_length.py
+    ("skipped_too_large_files", pa.int64()),
+    ("skipped_long_lines_files", pa.int64()),
+    ("skipped_binary_files", pa.int64()),
+    ("skipped_generated_files", pa.int64()),
+    ("clone_strategy", CATEGORY),
+    ("clone_seconds", pa.float64()),
+    ("clone_bytes", pa.int64()),
+])
+LIST_COLUMNS = [field.name for field in OUTPUT_SCHEMA if pa.types.is_list(field.type)]
+
+
+def build_output_table(all_metrics):
+    # fields missing from a record come out null, fields the schema doesn't know are dropped
+    return pa.Table.from_pylist(all_metrics, schema=OUTPUT_SCHEMA)
+
+
+def conform_to_output_schema(table):
+    # tables written before the schema existed hold int64 lists and plain strings
+    for field in OUTPUT_SCHEMA:
+        if field.name not in table.column_names:
+            table = table.append_column(field.name, pa.nulls(len(table), field.type))
+    return table.select(OUTPUT_SCHEMA.names).cast(OUTPUT_SCHEMA)
+
+
+def open_output_writer(output_location):
+    return pq.ParquetWriter(output_location, OUTPUT_SCHEMA, compression=COMPRESSION, use_dictionary=True,
+                            write_statistics=True)
+
+
+def write_output_table(table, output_location):
+    pq.write_table(table, output_location, row_group_size=ROW_GROUP_SIZE, compression=COMPRESSION,
+                   use_dictionary=True, write_statistics=True)
+
+
+def load_output(output_location=OUTPUT_LOCATION, columns=None, filters=None):
+    # filters such as [("count_stars", ">=", 1000)] are checked against row group statistics before anything is read
+    return pq.read_table(output_location, columns=columns, filters=filters)
+
+
+def get_list_column(table, name):
+    # (offsets, values) numpy views over a list column: row i holds values[offsets[i]:offsets[i + 1]]
+    column = table[name].combine_chunks()
+    if column.null_count:
+        column = column.fill_null(pa.scalar([], column.type))
+    values = column.values.to_numpy(zero_copy_only=False)
+    offsets = column.offsets.to_numpy()
+    return offsets - offsets[0], values[offsets[0]:offsets[-1]]
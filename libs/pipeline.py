@@ -0,0 +1,107 @@
+import time
+import queue
+import logging
+import threading
+
+STOP = object()
+
+
+def create_stage(name, function, workers, queue_size, on_error=None):
+    # on_error(item) turns an item the stage raised on into what the stage would have passed on, instead of dropping it
+    return {"name": name, "function": function, "workers": workers, "queue_size": queue_size, "on_error": on_error}
+
+
+def run_stage_worker(stage, input_queue, output_queue, stats, stats_lock):
+    while True:
+        item = input_queue.get()
+        if item is STOP:
+            return
+        start_time = time.perf_counter()
+        try:
+            result = stage["function"](item)
+        except Exception as e:
+            logging.error(f"{stage['name']} stage failed", exc_info=True)
+            result = stage["on_error"](item) if stage["on_error"] is not None else None
+        with stats_lock:
+            stats["processed"] += 1
+            stats["busy_seconds"] += time.perf_counter() - start_time
+        # a stage drops an item by returning None
+        if result is not None:
+            output_queue.put(result)
+
+
+def get_pipeline_status(stages, queues, stage_stats, start_time):
+    elapsed = time.perf_counter() - start_time
+    status = {}
+    for stage, input_queue in zip(stages, queues):
+        stats = stage_stats[stage["name"]]
+        status[stage["name"]] = {
+            "queue_depth": input_queue.qsize(),
+            "processed": stats["processed"],
+            "items_per_minute": round(stats["processed"] * 60 / elapsed, 2) if elapsed else 0.0,
+            # share of the stage's worker time spent working rather than waiting on its queue
+            "utilization": round(stats["busy_seconds"] / (elapsed * stage["workers"]), 3) if elapsed else 0.0,
+        }
+    return status
+
+
+def log_pipeline_status(status):
+    logging.info("pipeline: " + ", ".join(
+        f"{name} [queued {stats['queue_depth']}, done {stats['processed']}, "
+        f"{stats['items_per_minute']}/min, {stats['utilization']:.0%} busy]"
+        for name, stats in status.items()))
+
+
+def run_pipeline(items, stages, on_result, report_interval=60):
+    # each stage owns a bounded input queue, so a slow stage pushes back on the one before it instead of piling up
+    queues = [queue.Queue(maxsize=stage["queue_size"]) for stage in stages]
+    results_queue = queue.Queue()
+    stats_lock = threading.Lock()
+    stage_stats = {stage["name"]: {"processed": 0, "busy_seconds": 0.0} for stage in stages}
+    start_time = time.perf_counter()
+
+    stage_threads = []
+    for i, stage in enumerate(stages):
+        output_queue = queues[i + 1] if i + 1 < len(stages) else results_queue
+        threads = [threading.Thread(target=run_stage_worker, name=f"{stage['name']}-{n}", daemon=True,
+                                    args=(stage, queues[i], output_queue, stage_stats[stage["name"]], stats_lock))
+                   for n in range(stage["workers"])]
+        for thread in threads:
+            thread.start()
+        stage_threads.append(threads)
+
+    def consume_results():
+        while True:
+            result = results_queue.get()
+            if result is STOP:
+                return
+            on_result(result)
+
+    consumer = threading.Thread(target=consume_results, name="results", daemon=True)
+    consumer.start()
+
+    finished = threading.Event()
+
+    def report():
+        while not finished.wait(report_interval):
+            log_pipeline_status(get_pipeline_status(stages, queues, stage_stats, start_time))
+
+    reporter = threading.Thread(target=report, name="reporter", daemon=True)
+    reporter.start()
+
+    for item in items:
+        queues[0].put(item)
+    # shut the stages down in order, so every item already in flight still reaches the end
+    for input_queue, threads in zip(queues, stage_threads):
+        for _ in threads:
+            input_queue.put(STOP)
+        for thread in threads:
+            thread.join()
+    results_queue.put(STOP)
+    consumer.join()
+    finished.set()
+    reporter.join()
+
+    status = get_pipeline_status(stages, queues, stage_stats, start_time)
+    log_pipeline_status(status)
+    return status
@@ -0,0 +1,174 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+PLOT_WORKERS = mp.cpu_count()
+PLOT_INDEX_NAME = "plot_index.json"  # {plot location: hash of its data and parameters}, next to the plots
+FIGURE_SIZE = (6, 4)
+SCATTER_HEXBIN_THRESHOLD = 20000  # above this many points a scatter becomes a hexbin density plot
+HEXBIN_GRID_SIZE = 50
+MAX_CURVE_POINTS = 5000  # cdf and llcd curves are drawn through evenly spaced quantiles past this
+ANNOTATION_STYLE = dict(fontsize=9, verticalalignment='top', bbox=dict(facecolor='white', alpha=0.5))
+
+# a plot is a dict: {"kind": ..., "location": png path, "data": {name: numpy array}, "params": {json values}}
+
+
+def histogram_plot(plt, data, params):
+    import seaborn as sns
+    values = data["values"]
+    sns.histplot(values, bins=params["bins"], kde=False)
+    add_mean_median_lines(plt, values)
+    plt.title(f"Histogram of {params['column']}")
+    plt.xlabel(params["column"])
+    plt.ylabel("Frequency")
+    plt.legend()
+
+
+def cdf_plot(plt, data, params):
+    values = data["values"]
+    sorted_vals, cdf = thin_curve(np.sort(values), np.arange(1, len(values) + 1) / len(values))
+    plt.plot(sorted_vals, cdf, label="CDF")
+    add_mean_median_lines(plt, values)
+    plt.title(f"CDF of {params['column']}")
+    plt.xlabel(params["column"])
+    plt.ylabel("Cumulative Probability")
+    plt.legend()
+
+
+def llcd_plot(plt, data, params):
+    vals_sorted = np.sort(data["values"][data["values"] != 0])
+    ccdf = 1.0 - np.arange(1, len(vals_sorted) + 1) / len(vals_sorted)
+    plt.loglog(*thin_curve(vals_sorted, ccdf))
+    plt.title(f"Log-Log Complementary CDF of {params['column']}")
+    plt.xlabel(params["column"])
+    plt.ylabel("1 - CDF")
+
+
+def scatter_plot(plt, data, params):
+    x, y = data["x"], data["y"]
+    if len(x) > SCATTER_HEXBIN_THRESHOLD:
+        # tens of thousands of overlapping dots say less than their density, and regplot's bootstrap is the slow part
+        plt.hexbin(x, y, gridsize=HEXBIN_GRID_SIZE, bins="log", mincnt=1, cmap="Blues")
+        plt.colorbar(label="repositories")
+        slope, intercept = np.polyfit(x, y, 1)
+        line_x = np.array([x.min(), x.max()])
+        plt.plot(line_x, slope * line_x + intercept, color="red")
+    else:
+        import seaborn as sns
+        sns.regplot(x=x, y=y, scatter_kws={"s": 10}, line_kws={"color": "red"})
+    plt.title(f"{params['x_column']} vs {params['y_column']}")
+    plt.xlabel(params["x_column"])
+    plt.ylabel(params["y_column"])
+    plt.text(0.05, 0.95, params["annotation"], transform=plt.gca().transAxes, **ANNOTATION_STYLE)
+
+
+def boxplot_plot(plt, data, params):
+    import seaborn as sns
+    sns.boxplot(x=data["groups"], y=data["values"])
+    plt.title(params["title"])
+    plt.xlabel(params["x_label"])
+    plt.ylabel(params["column"])
+    plt.text(0.05, 0.95, params["annotation"], transform=plt.gca().transAxes, **ANNOTATION_STYLE)
+
+
+PLOT_KINDS = {
+    "histogram": histogram_plot,
+    "cdf": cdf_plot,
+    "llcd": llcd_plot,
+    "scatter": scatter_plot,
+    "boxplot": boxplot_plot,
+}
+
+
+def add_mean_median_lines(plt, values):
+    mean_val = values.mean()
+    median_val = np.median(values)
+    plt.axvline(mean_val, color="red", linestyle="--", label=f"Mean: {mean_val:.2f}")
+    plt.axvline(median_val, color="blue", linestyle=":", label=f"Median: {median_val:.2f}")
+
+
+def thin_curve(x, y):
+    if len(x) <= MAX_CURVE_POINTS:
+        return x, y
+    kept = np.linspace(0, len(x) - 1, MAX_CURVE_POINTS).astype(int)
+    return x[kept], y[kept]
+
+
+def init_plot_worker():
+    import matplotlib
+    matplotlib.use("Agg")  # files only, no display or gui event loop
+
+
+def render_plot(plot):
+    import matplotlib.pyplot as plt
+    start_time = time.perf_counter()
+    plt.figure(figsize=FIGURE_SIZE)
+    try:
+        PLOT_KINDS[plot["kind"]](plt, plot["data"], plot["params"])
+        plt.tight_layout()
+        plt.savefig(plot["location"])
+    finally:
+        plt.close()
+    return plot["location"], time.perf_counter() - start_time
+
+
+def get_plot_hash(plot, array_hashes):
+    # the same column feeds many plots, so each array is only hashed once per run
+    digest = hashlib.sha1(json.dumps([plot["kind"], plot["params"]], sort_keys=True, default=str).encode())
+    for name in sorted(plot["data"]):
+        array = plot["data"][name]
+        if id(array) not in array_hashes:
+            array_hashes[id(array)] = hashlib.sha1(np.ascontiguousarray(array).view(np.uint8)).hexdigest()
+        digest.update(f"{name}:{array.dtype}:{array_hashes[id(array)]}".encode())
+    return digest.hexdigest()
+
+
+def load_plot_index(plots_location):
+    try:
+        with open(os.path.join(plots_location, PLOT_INDEX_NAME), 'r') as index_file:
+            return json.load(index_file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def save_plot_index(plots_location, plot_index):
+    index_location = os.path.join(plots_location, PLOT_INDEX_NAME)
+    with open(index_location + ".tmp", 'w') as index_file:
+        json.dump(plot_index, index_file, indent=1, sort_keys=True)
+    os.replace(index_location + ".tmp", index_location)
+
+
+def render_plots(plots, plots_location, plot_workers=PLOT_WORKERS, force=False):
+    # renders only the plots whose data or parameters changed since the last run, spread over a process pool
+    os.makedirs(plots_location, exist_ok=True)
+    plot_index = load_plot_index(plots_location)
+    array_hashes = {}
+    pending = []
+    for plot in plots:
+        plot_hash = get_plot_hash(plot, array_hashes)
+        if not force and plot_index.get(plot["location"]) == plot_hash and os.path.exists(plot["location"]):
+            continue
+        plot_index.pop(plot["location"], None)
+        pending.append((plot, plot_hash))
+    logging.info(f"rendering {len(pending)} of {len(plots)} plots, the rest are up to date")
+    if not pending:
+        return 0
+
+    start_time = time.perf_counter()
+    # spawned workers, as in the scan pipeline; pyplot isn't safe to carry across a fork
+    with ProcessPoolExecutor(max_workers=min(plot_workers, len(pending)), mp_context=mp.get_context("spawn"),
+                             initializer=init_plot_worker) as executor:
+        try:
+            for (plot, plot_hash), (location, seconds) in zip(pending, executor.map(render_plot, [plot for plot, _ in pending])):
+                plot_index[location] = plot_hash
+                logging.info(f"{location}: rendered in {seconds:.2f}s")
+        finally:
+            save_plot_index(plots_location, plot_index)
+    logging.info(f"rendered {len(pending)} plots in {time.perf_counter() - start_time:.1f}s")
+    return len(pending)
@@ -0,0 +1,81 @@
+import os
+import sys
+import json
+import time
+import sqlite3
+
+try: # macOS
+    CACHE_LOCATION = os.path.join(os.path.dirname(sys.modules['__main__'].__file__), "cache", "class_length.sqlite")
+except: # Windows
+    CACHE_LOCATION = os.path.join(os.getcwd(), "cache", "class_length.sqlite")
+
+MAX_CACHE_BYTES = 2 * 1024 ** 3
+EVICTION_TARGET = 0.9  # evict down to this fraction of MAX_CACHE_BYTES so eviction doesn't run on every write
+
+
+def open_cache(cache_location=CACHE_LOCATION):
+    os.makedirs(os.path.dirname(cache_location), exist_ok=True)
+    # every pool worker opens its own connection; WAL lets them read while one of them writes
+    connection = sqlite3.connect(cache_location, timeout=60)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS class_records (
+            blob_sha TEXT NOT NULL,
+            parser_version TEXT NOT NULL,
+            records TEXT NOT NULL,
+            last_used REAL NOT NULL,
+            PRIMARY KEY (blob_sha, parser_version)
+        )
+    """)
+    connection.execute("CREATE INDEX IF NOT EXISTS class_records_last_used ON class_records (last_used)")
+    connection.commit()
+    return connection
+
+
+def get_cached_records(connection, blob_shas, parser_version):
+    cached = {}
+    blob_shas = list(blob_shas)
+    for i in range(0, len(blob_shas), 500):  # stay below sqlite's bound-parameter limit
+        batch = blob_shas[i:i + 500]
+        rows = connection.execute(
+            f"SELECT blob_sha, records FROM class_records WHERE parser_version = ? "
+            f"AND blob_sha IN ({','.join('?' * len(batch))})",
+            [parser_version, *batch])
+        for blob_sha, records in rows:
+            cached[blob_sha] = json.loads(records)
+    if cached:
+        now = time.time()
+        connection.executemany("UPDATE class_records SET last_used = ? WHERE blob_sha = ? AND parser_version = ?",
+                               [(now, blob_sha, parser_version) for blob_sha in cached])
+        connection.commit()
+    return cached
+
+
+def store_records(connection, records_by_blob, parser_version, max_cache_bytes=MAX_CACHE_BYTES):
+    if not records_by_blob:
+        return
+    now = time.time()
+    connection.executemany("INSERT OR REPLACE INTO class_records VALUES (?, ?, ?, ?)",
+                           [(blob_sha, parser_version, json.dumps(records, separators=(',', ':')), now)
+                            for blob_sha, records in records_by_blob.items()])
+    connection.commit()
+    evict_least_recently_used(connection, max_cache_bytes)
+
+
+def get_cache_size(connection):
+    page_size = connection.execute("PRAGMA page_size").fetchone()[0]
+    page_count = connection.execute("PRAGMA page_count").fetchone()[0]
+    free_pages = connection.execute("PRAGMA freelist_count").fetchone()[0]
+    return (page_count - free_pages) * page_size
+
+
+def evict_least_recently_used(connection, max_cache_bytes=MAX_CACHE_BYTES):
+    cache_size = get_cache_size(connection)
+    if cache_size <= max_cache_bytes:
+        return
+    entries = connection.execute("SELECT COUNT(*) FROM class_records").fetchone()[0]
+    # rows are roughly the same size, so drop the oldest share of them that brings the cache under target
+    to_evict = entries - int(entries * max_cache_bytes * EVICTION_TARGET / cache_size)
+    connection.execute("DELETE FROM class_records WHERE rowid IN "
+                       "(SELECT rowid FROM class_records ORDER BY last_used LIMIT ?)", (max(to_evict, 1),))
+    connection.commit()
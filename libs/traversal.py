@@ -0,0 +1,203 @@
+import os
+import re
+import time
+import logging
+
+from libs.instrumentation import add_time, count
+
+# directories never worth descending into: version control metadata, dependencies and build output
+PRUNED_DIRECTORIES = frozenset([".git", ".hg", ".svn", "node_modules", "bower_components", "build", "target",
+                                ".gradle", "generated-sources", "generated-test-sources"])
+# more paths to leave out, in .gitignore syntax, e.g. "src/test/" for tests or "**/generated/" for generated code
+EXCLUDE_PATTERNS = []
+HONOR_GITIGNORE = True
+HONOR_LINGUIST_ATTRIBUTES = True  # leave out what .gitattributes marks linguist-vendored or linguist-generated
+LINGUIST_ATTRIBUTES = ("linguist-vendored", "linguist-generated")
+
+
+def translate_glob(pattern):
+    regex = ''
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith('**/', i):
+            regex += '(?:.*/)?'
+            i += 3
+        elif pattern.startswith('**', i):
+            regex += '.*'
+            i += 2
+        elif pattern[i] == '*':
+            regex += '[^/]*'
+            i += 1
+        elif pattern[i] == '?':
+            regex += '[^/]'
+            i += 1
+        elif pattern[i] == '[' and pattern.find(']', i + 2) != -1:
+            end = pattern.find(']', i + 2)
+            char_class = pattern[i + 1:end]
+            regex += '[' + ('^' + char_class[1:] if char_class[0] in '!^' else char_class).replace('\\', '\\\\') + ']'
+            i = end + 1
+        elif pattern[i] == '\\' and i + 1 < len(pattern):
+            regex += re.escape(pattern[i + 1])
+            i += 2
+        else:
+            regex += re.escape(pattern[i])
+            i += 1
+    return regex
+
+
+def compile_rule(pattern, negated=False):
+    # (regex over the path below the rule's directory, negated, directory only), as git reads a .gitignore line
+    directory_only = pattern.endswith('/')
+    pattern = pattern.rstrip('/')
+    if not pattern:
+        return None
+    anchored = '/' in pattern  # a slash anywhere but at the end ties the pattern to the rule's directory
+    regex = ('' if anchored else '(?:.*/)?') + translate_glob(pattern.lstrip('/'))
+    return re.compile(regex), negated, directory_only
+
+
+def parse_ignore_rules(text):
+    rules = []
+    for line in text.splitlines():
+        line = line.rstrip()
+        if not line or line.startswith('#'):
+            continue
+        negated = line.startswith('!')
+        if negated or line.startswith('\\'):
+            line = line[1:]
+        rule = compile_rule(line, negated)
+        if rule is not None:
+            rules.append(rule)
+    return rules
+
+
+def parse_attribute_rules(text):
+    # only the linguist attributes matter here; "-linguist-vendored" or "=false" takes a path back in
+    rules = []
+    for line in text.splitlines():
+        parts = line.split()
+        if not parts or parts[0].startswith('#'):
+            continue
+        for attribute in parts[1:]:
+            name, _, value = attribute.lstrip('-!').partition('=')
+            if name in LINGUIST_ATTRIBUTES:
+                rule = compile_rule(parts[0], negated=attribute[0] in '-!' or value == "false")
+                if rule is not None and not rule[2]:
+                    rules.append(rule)
+    return rules
+
+
+def create_path_filter(exclude_patterns=None):
+    # paths are relative to the repo root and "/" separated; rules are kept as (directory prefix, rules) of every
+    # file that declared some, parents before children
+    path_filter = {"ignore_rules": [], "attribute_rules": [], "excluded_directories": {}}
+    patterns = EXCLUDE_PATTERNS if exclude_patterns is None else exclude_patterns
+    if patterns:
+        add_rules(path_filter, "ignore_rules", "", parse_ignore_rules("\n".join(patterns)))
+    return path_filter
+
+
+def add_rules(path_filter, kind, directory, rules):
+    if rules:
+        path_filter[kind].append((directory + "/" if directory else "", rules))
+        path_filter[kind].sort(key=lambda item: item[0].count("/"))
+
+
+def add_rules_file(path_filter, directory, file_name, text):
+    if file_name == ".gitignore" and HONOR_GITIGNORE:
+        add_rules(path_filter, "ignore_rules", directory, parse_ignore_rules(text))
+    elif file_name == ".gitattributes" and HONOR_LINGUIST_ATTRIBUTES:
+        add_rules(path_filter, "attribute_rules", directory, parse_attribute_rules(text))
+
+
+def has_rules(path_filter):
+    return bool(path_filter["ignore_rules"] or path_filter["attribute_rules"])
+
+
+def matches_rules(rules_by_directory, path, is_directory):
+    # the last matching rule wins, and a deeper directory's rules come after its parents'
+    matched = False
+    for prefix, rules in rules_by_directory:
+        if not path.startswith(prefix):
+            continue
+        relative_path = path[len(prefix):]
+        for regex, negated, directory_only in rules:
+            if (is_directory or not directory_only) and regex.fullmatch(relative_path):
+                matched = not negated
+    return matched
+
+
+def is_excluded(path_filter, path, is_directory=False):
+    if is_directory:
+        return path.rsplit('/', 1)[-1] in PRUNED_DIRECTORIES or matches_rules(path_filter["ignore_rules"], path, True)
+    return matches_rules(path_filter["ignore_rules"], path, False) or \
+        matches_rules(path_filter["attribute_rules"], path, False)
+
+
+def is_excluded_path(path_filter, path):
+    # for a listing that has every path at once: a path is out when any directory above it is
+    excluded_directories = path_filter["excluded_directories"]
+    slash = path.find('/')
+    while slash != -1:
+        directory = path[:slash]
+        if directory not in excluded_directories:
+            excluded_directories[directory] = is_excluded(path_filter, directory, True)
+        if excluded_directories[directory]:
+            return True
+        slash = path.find('/', slash + 1)
+    return is_excluded(path_filter, path)
+
+
+def iter_code_files(root, match_language, exclude_patterns=None, walk_stats=None):
+    # (language, path, size) of every code file under root, handed out the moment the walk reaches it
+    path_filter = create_path_filter(exclude_patterns)
+    stats = {"directories": 0, "files": 0, "code_files": 0, "pruned": 0, "excluded": 0, "seconds": 0.0}
+    resumed = time.perf_counter()
+    directories = [('', root)]
+    while directories:
+        relative_directory, directory = directories.pop()
+        stats["directories"] += 1
+        try:
+            with os.scandir(directory) as scanned:
+                entries = list(scanned)
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.name in (".gitignore", ".gitattributes") and entry.is_file(follow_symlinks=False):
+                with open(entry.path, 'r', encoding='utf-8', errors='ignore') as rules_file:
+                    add_rules_file(path_filter, relative_directory, entry.name, rules_file.read())
+
+        subdirectories = []
+        prefix = relative_directory + "/" if relative_directory else ""
+        filtered = has_rules(path_filter)  # most repos have no rules at all, and then names are all that matter
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if entry.name in PRUNED_DIRECTORIES:
+                    stats["pruned"] += 1
+                elif filtered and is_excluded(path_filter, prefix + entry.name, True):
+                    stats["excluded"] += 1
+                else:
+                    subdirectories.append((prefix + entry.name, entry.path))
+            elif entry.is_file(follow_symlinks=False):
+                stats["files"] += 1
+                language = match_language(entry.name)
+                if language is None:
+                    continue
+                if filtered and is_excluded(path_filter, prefix + entry.name):
+                    stats["excluded"] += 1
+                    continue
+                stats["code_files"] += 1
+                size = entry.stat(follow_symlinks=False).st_size
+                stats["seconds"] += time.perf_counter() - resumed
+                yield language, entry.path, size
+                resumed = time.perf_counter()
+        directories.extend(reversed(subdirectories))
+    stats["seconds"] += time.perf_counter() - resumed
+
+    logging.info(f"walked {stats['directories']} directories and {stats['files']} files in {stats['seconds']:.2f}s - "
+                 f"{stats['files'] / stats['seconds'] if stats['seconds'] else 0:,.0f} files/s, "
+                 f"{stats['code_files']} code files, {stats['pruned']} directories pruned, {stats['excluded']} paths excluded")
+    add_time("walk", stats["seconds"])
+    count("files_walked", stats["files"])
+    if walk_stats is not None:
+        walk_stats.update(stats)
@@ -0,0 +1,193 @@
+import os
+import time
+import signal
+import logging
+import multiprocessing as mp
+from multiprocessing.connection import wait
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+TIMED_OUT = "timed_out"
+WORKER_DIED = "worker_died"
+TASK_ERROR = "task_error"
+POLL_SECONDS = 1
+REPORT_INTERVAL_SECONDS = 60
+RETIRE_SECONDS = 10  # a retiring worker gets this long to exit on its own before it is killed
+
+
+def limit_worker_memory(memory_limit):
+    # RLIMIT_DATA caps what the worker allocates but not the pack files git maps in, so a mirror read stays possible;
+    # past the limit the allocation raises MemoryError inside the task instead of taking the box down
+    if not memory_limit or resource is None or not hasattr(resource, "RLIMIT_DATA"):
+        return
+    try:
+        resource.setrlimit(resource.RLIMIT_DATA, (memory_limit, memory_limit))
+    except (ValueError, OSError):
+        logging.error("could not limit worker memory", exc_info=True)
+
+
+def run_worker(connection, function, initializer, initargs, memory_limit):
+    # a process group of its own, so killing an overrunning worker takes the git processes it started along
+    if hasattr(os, "setpgrp"):
+        os.setpgrp()
+    limit_worker_memory(memory_limit)
+    if initializer is not None:
+        initializer(*initargs)
+    while True:
+        task = connection.recv()
+        if task is None:
+            return
+        index, item = task
+        try:
+            connection.send((index, True, function(item)))
+        except Exception as e:
+            logging.error("worker task failed", exc_info=True)
+            connection.send((index, False, repr(e)))
+
+
+def start_worker(context, function, initializer, initargs, memory_limit):
+    # every worker talks to the scheduler over a pipe of its own - no shared queue or lock a killed worker could
+    # leave broken, and no manager process in between
+    connection, worker_connection = context.Pipe()
+    process = context.Process(target=run_worker, daemon=True,
+                              args=(worker_connection, function, initializer, initargs, memory_limit))
+    process.start()
+    worker_connection.close()
+    return {"process": process, "connection": connection, "task": None, "started_at": None, "tasks_done": 0}
+
+
+def kill_worker(worker):
+    process = worker["process"]
+    if process.is_alive():
+        try:
+            if hasattr(os, "killpg"):
+                os.killpg(process.pid, signal.SIGKILL)
+            else:
+                process.kill()
+        except ProcessLookupError:
+            pass
+    process.join()
+    worker["connection"].close()
+
+
+def retire_worker(worker):
+    # asks the worker to exit once it's idle and returns at once; reap_workers sees it gone, or kills it
+    try:
+        worker["connection"].send(None)
+    except OSError:
+        pass
+    worker["retire_by"] = time.monotonic() + RETIRE_SECONDS
+
+
+def reap_workers(retiring, wait_seconds=0):
+    # the retiring workers still around, waiting up to wait_seconds for them to exit before killing the late ones
+    deadline = time.monotonic() + wait_seconds
+    still_retiring = []
+    for worker in retiring:
+        worker["process"].join(max(deadline - time.monotonic(), 0))
+        if not worker["process"].is_alive() or time.monotonic() > worker["retire_by"]:
+            kill_worker(worker)
+        else:
+            still_retiring.append(worker)
+    return still_retiring
+
+
+def log_pool_status(workers, stats, total):
+    now = time.monotonic()
+    running = [now - worker["started_at"] for worker in workers if worker["task"] is not None]
+    logging.info(f"pool: {stats['done']}/{total} done, {len(running)} running"
+                 + (f" (longest for {max(running):.0f}s)" if running else "")
+                 + f", {stats[TIMED_OUT]} timed out, {stats[WORKER_DIED]} lost with their worker, "
+                   f"{stats['recycled']} workers recycled")
+
+
+def run_worker_pool(items, function, on_result, on_failure, workers, task_timeout=None, memory_limit=None,
+                    max_tasks_per_worker=None, initializer=None, initargs=()):
+    # items go out one at a time, in the given order, to whichever worker is free, so a few slow ones never hold
+    # back the rest. on_result(item, result) or on_failure(item, reason, worker pid) is called for each, in the
+    # calling process; a worker running past task_timeout seconds or dying mid-item is killed and replaced, and after
+    # max_tasks_per_worker items a worker is replaced anyway, giving back whatever memory it held on to
+    context = mp.get_context("spawn")
+    items = list(items)
+    stats = {"done": 0, TIMED_OUT: 0, WORKER_DIED: 0, TASK_ERROR: 0, "recycled": 0}
+    pool = [start_worker(context, function, initializer, initargs, memory_limit)
+            for _ in range(min(workers, len(items)))]
+    retiring = []  # recycled workers on their way out, never waited on while items are being handed out
+    next_item = 0
+    last_report = time.monotonic()
+
+    def replace(worker):
+        pool[pool.index(worker)] = start_worker(context, function, initializer, initargs, memory_limit)
+
+    try:
+        while True:
+            for worker in pool:
+                if worker["task"] is None and next_item < len(items):
+                    worker["task"] = next_item
+                    worker["started_at"] = time.monotonic()
+                    worker["connection"].send((next_item, items[next_item]))
+                    next_item += 1
+            busy = [worker for worker in pool if worker["task"] is not None]
+            if not busy:
+                break
+
+            ready = wait([worker["connection"] for worker in busy], timeout=POLL_SECONDS)
+            for worker in busy:
+                if worker["connection"] not in ready:
+                    continue
+                try:
+                    index, succeeded, payload = worker["connection"].recv()
+                except (EOFError, OSError):
+                    continue  # the worker is gone, found below
+                worker["task"] = None
+                worker["tasks_done"] += 1
+                stats["done"] += 1
+                if succeeded:
+                    on_result(items[index], payload)
+                else:
+                    stats[TASK_ERROR] += 1
+                    on_failure(items[index], TASK_ERROR, worker["process"].pid)
+                if max_tasks_per_worker and worker["tasks_done"] >= max_tasks_per_worker:
+                    retire_worker(worker)
+                    retiring.append(worker)
+                    replace(worker)
+                    stats["recycled"] += 1
+            retiring = reap_workers(retiring)
+
+            now = time.monotonic()
+            for worker in list(pool):
+                if worker["task"] is None:
+                    continue
+                if task_timeout and now - worker["started_at"] > task_timeout:
+                    reason = TIMED_OUT
+                    logging.error(f"worker gave up on item {worker['task'] + 1} after {task_timeout}s")
+                elif not worker["process"].is_alive():
+                    reason = WORKER_DIED
+                    logging.error(f"worker died on item {worker['task'] + 1} "
+                                  f"(exit code {worker['process'].exitcode})")
+                else:
+                    continue
+                index = worker["task"]
+                kill_worker(worker)
+                replace(worker)
+                stats[reason] += 1
+                stats["done"] += 1
+                on_failure(items[index], reason, worker["process"].pid)
+
+            if now - last_report >= REPORT_INTERVAL_SECONDS:
+                log_pool_status(pool, stats, len(items))
+                last_report = now
+    finally:
+        for worker in pool:
+            if worker["task"] is None:
+                retire_worker(worker)
+                retiring.append(worker)
+            else:
+                kill_worker(worker)
+        for worker in reap_workers(retiring, RETIRE_SECONDS):
+            kill_worker(worker)
+    log_pool_status(pool, stats, len(items))
+    return stats
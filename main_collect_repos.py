@@ -1,15 +1,19 @@
 import os
 import json
 import datetime
-import string
 import logging
+import threading
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+from libs.class_length import MIN_CODE_FILES
+from libs.description import BOOK_KEYWORDS, classify_language, classify_languages, find_keyword
+from libs.gate import check_code_files_gate, passes_gate
+from libs.github_client import github_get, github_get_json
+from libs.github_graphql import fetch_repos_metadata
+from libs.instrumentation import start_run, repo_scope, timed, write_run_report
+from libs.languages import get_language_by_github_name
 
-import requests
-import langid
-
-from libs.github_api import handle_repo_rate_limit, handle_search_rate_limit
-
-GITHUB_TOKEN = os.environ['GITHUB_TOKEN']
 logging.basicConfig(level=logging.INFO, format="%(levelname)s - %(message)s")
 
 WISHED_LIST_SIZE = 4000
@@ -17,19 +21,15 @@ PER_PAGE = 100
 
 LANG = "JAVA"
 DAYS_LIMIT = 365
-MIN_CODE_FILES = 50
 MIN_CONTRIBUTORS = 3
-
-BOOK_KEYWORDS = ["learn", "learning", "tutorial", "tutorials", "book", "books", "guide", "guides", "Example",
-                 "Examples", "Introduction", "Introductions", "Course", "Courses", "Getting Started"]
-
-
+CHECK_WORKERS = 16  # repos whose network checks run at the same time
 
 BAD_DESCRIPTION = "bad_description"
 TOO_FEW_CODE_FILES = "too_few_code_files"
 NOT_ACTIVE = "not_active"
 TOO_FEW_CONTRIBUTORS = "too_few_contributors"
 FORK = "fork"
+rejection_reason_histogram_lock = threading.Lock()
 rejection_reason_histogram = {
     BAD_DESCRIPTION: 0,
     TOO_FEW_CODE_FILES: 0,
@@ -39,63 +39,52 @@ rejection_reason_histogram = {
 }
 
 
-def check_if_bad_description(repo):
+def check_if_bad_description(repo, description_language=None):
     repo_description = repo["description"]
     repo_name = repo["full_name"]
     if repo_description is None:
         logging.info(f"repo ({repo_name}) was filtered due to empty description")
         return True
 
-    description_language = langid.classify(repo_description)[0]
+    if description_language is None:
+        description_language = classify_language(repo_description)
     if description_language != 'en':
         logging.info(
             f"repo ({repo_name}) was filtered due to description language - {description_language}")
         return True
 
-    # clean description
-    punctuation = string.punctuation + "0123456789"
-    for char in punctuation:
-        repo_description = repo_description.replace(char, '')
-
-
-    for key_word in BOOK_KEYWORDS:
-        if key_word.upper() in repo_description.upper():
-            logging.info(
-                f"repo ({repo_name}) was filtered due to use of prohibited key_word in the description - '{key_word}'")
-            return True
+    key_word = find_keyword(repo_description, BOOK_KEYWORDS)
+    if key_word is not None:
+        logging.info(
+            f"repo ({repo_name}) was filtered due to use of prohibited key_word in the description - '{key_word}'")
+        return True
     return False
 
 
 def check_if_too_few_code_files(repo):
+    # counted the way the scanner counts them, so a collected repo is never skipped by the scan for its size
     repo_name = repo["full_name"]
-    api_url = f"https://api.github.com/search/code?q=language:{LANG}+repo:{repo_name}"
-    headers = {'Authorization': f'token {GITHUB_TOKEN}'}
-    response = requests.get(api_url, headers=headers)
-    response = handle_search_rate_limit(response)
-
-    search_results = json.loads(response.text)
-    if "total_count" not in search_results or search_results["total_count"] < MIN_CODE_FILES:
-        try:
-            logging.info(
-                f"repo ({repo_name}) was filtered due to amount of code files - {search_results['total_count']} files only")
-        except:
-            logging.error("no total_count")
-            logging.error(search_results)
+    try:
+        verdict = check_code_files_gate(repo["html_url"], [get_language_by_github_name(LANG)], MIN_CODE_FILES)
+    except Exception as e:
+        logging.error(f"could not count code files of {repo_name}")
+        logging.error(e)
+        return True
+    if not passes_gate(verdict):
+        logging.info(
+            f"repo ({repo_name}) was filtered due to amount of code files - {verdict['code_files']} files only")
         return True
 
     return False
 
 
-def check_if_not_active(repo):  # check if there were any commits in last 50 days
+def check_if_not_active(repo, repo_metadata=None):  # check if there were any commits in last 50 days
     repo_name = repo["full_name"]
-    commit_api_url = f"https://api.github.com/repos/{repo_name}/commits"
-    headers = {
-        'Authorization': 'token %s' % GITHUB_TOKEN
-    }
-    response = requests.get(commit_api_url, headers=headers)
-    if int(response.headers["X-RateLimit-Remaining"]) == 0:
-        response = handle_repo_rate_limit(response)
-    commit_date = datetime.date.fromisoformat(json.loads(response.text)[0]["commit"]["committer"]["date"][:10])
+    if repo_metadata is not None and repo_metadata["last_commit_date"]:
+        last_commit_date = repo_metadata["last_commit_date"]
+    else:
+        last_commit_date = github_get_json(f"repos/{repo_name}/commits", {'per_page': '1'})[0]["commit"]["committer"]["date"]
+    commit_date = datetime.date.fromisoformat(last_commit_date[:10])
     delta = datetime.date.today() - commit_date
     if delta.days > DAYS_LIMIT:
         logging.info(f"repo ({repo_name}) was filtered because not active - {delta.days} days")
@@ -110,26 +99,13 @@ def check_if_fork(repo):
     return False
 
 def check_if_too_few_contributors(repo):
-    status = True
-    counter = 0
-    sum_contributors = 0
-    while status:
-        counter = counter + 1
-        contributors_url = repo["contributors_url"]
-        params = {
-            'anon': '1',
-            'page': str(counter)
-        }
-        headers = {'Authorization': f'token {GITHUB_TOKEN}'}
-        response = requests.get(contributors_url, headers=headers, params=params)
-        if int(response.headers["X-RateLimit-Remaining"]) == 0:
-            response = handle_repo_rate_limit(response)
-        data = json.loads(response.text)
-        sum_contributors = sum_contributors + len(data)
-        if len(data) == 0:
-            status = False
-        if sum_contributors > MIN_CONTRIBUTORS:
-            return False
+    # a single page of MIN_CONTRIBUTORS entries tells whether there are at least that many
+    contributors = github_get(repo["contributors_url"], {'anon': '1', 'per_page': str(MIN_CONTRIBUTORS)})
+    if contributors.status_code == 204:  # empty repository
+        sum_contributors = 0
+    else:
+        contributors.raise_for_status()
+        sum_contributors = len(contributors.json())
 
     if sum_contributors < MIN_CONTRIBUTORS:
         logging.info(f"repo ({repo['full_name']}) was filtered because it has less than {MIN_CONTRIBUTORS} contributors")
@@ -137,33 +113,50 @@ def check_if_too_few_contributors(repo):
     return False
 
 
-def check_should_collect_repo(repo):
-    if check_if_fork(repo):  # no further requests
-        rejection_reason_histogram[FORK] += 1
-        return False
+def reject(reason):
+    # network checks run on several threads at once
+    with rejection_reason_histogram_lock:
+        rejection_reason_histogram[reason] += 1
 
-    if check_if_bad_description(repo):  # no further requests
-        rejection_reason_histogram[BAD_DESCRIPTION] += 1
-        return False
 
-    if check_if_not_active(repo):  # single repos request
-        rejection_reason_histogram[NOT_ACTIVE] += 1
+def passes_local_checks(repo, description_language=None):
+    if check_if_fork(repo):  # no further requests
+        reject(FORK)
         return False
 
-    if check_if_too_few_contributors(repo):  # single repos request
-        rejection_reason_histogram[TOO_FEW_CONTRIBUTORS] += 1
+    if check_if_bad_description(repo, description_language):  # no further requests
+        reject(BAD_DESCRIPTION)
         return False
 
-    if check_if_too_few_code_files(repo):  # single search request
-        rejection_reason_histogram[TOO_FEW_CODE_FILES] += 1
-        return False
+    return True
 
+
+def passes_network_checks(repo, repo_metadata=None, cancelled=None):
+    # cheapest first: activity is known from the prefetched metadata, contributors take one small api request, and
+    # counting code files takes a treeless clone - the only check that transfers any of the repository, so it runs
+    # last and only for repos that passed everything else
+    network_checks = [
+        (partial(check_if_not_active, repo_metadata=repo_metadata), NOT_ACTIVE),  # no request when prefetched
+        (check_if_too_few_contributors, TOO_FEW_CONTRIBUTORS),  # single contributors request
+        (check_if_too_few_code_files, TOO_FEW_CODE_FILES),  # single treeless clone
+    ]
+    with repo_scope(repo["html_url"]):
+        for check, reason in network_checks:
+            if cancelled is not None and cancelled.is_set():
+                return False
+            with timed(f"check_{reason}"):
+                rejected = check(repo)
+            if rejected:
+                reject(reason)
+                return False
     return True
 
 
+def check_should_collect_repo(repo, repo_metadata=None):
+    return passes_local_checks(repo) and passes_network_checks(repo, repo_metadata)
+
+
 def set_search_request(query, page):
-    api_url = f"https://api.github.com/search/repositories"
-    headers = {'Authorization': f'token {GITHUB_TOKEN}'}
     params = {
         'q': f'{query} language:{LANG}',
         'sort': 'stars',
@@ -171,12 +164,21 @@ def set_search_request(query, page):
         'order': 'desc',
         'per_page': f'{PER_PAGE}'
     }
-    response = requests.get(api_url, params=params, headers=headers)
-    response = handle_search_rate_limit(response)
-    search_results = json.loads(response.text)
+    with timed("search_api"):
+        search_results = github_get("search/repositories", params).json()
     return search_results
 
 
+def prefetch_repos_metadata(repos):
+    # the last commit date of the whole search page in a couple of graphql queries
+    try:
+        with timed("metadata_graphql"):
+            return fetch_repos_metadata([repo["full_name"] for repo in repos])
+    except Exception as e:
+        logging.error("could not prefetch repositories metadata", exc_info=True)
+        return {}
+
+
 def save_output(output_lst):
     logging.info(">>>")
     logging.info(f"{len(output_lst)} repositories approved")
@@ -189,41 +191,66 @@ def save_output(output_lst):
     with open(os.path.join("outputs", "rejection_reasons.json"), 'w') as output_file:
         json.dump(rejection_reason_histogram, output_file, indent=4)
 
+    write_run_report({"approved": len(output_lst), "rejection_reasons": rejection_reason_histogram})
+
 
 def collect_repos():
+    start_run("collect")
     output_lst = []
     last_repo_stars = 100000
     page = 0
-    while len(output_lst) < WISHED_LIST_SIZE and last_repo_stars > 0:
-        try:
-            search_results = set_search_request(f"stars:<{last_repo_stars}", page)
-            repos = search_results['items']
-        except Exception as e:
-            logging.error("Broken", exc_info=True)
-            save_output(output_lst)
-            quit()
-        for index, repo in enumerate(repos):
+    cancelled = threading.Event()
+    with ThreadPoolExecutor(1) as search_executor, ThreadPoolExecutor(CHECK_WORKERS) as check_executor:
+        next_search = search_executor.submit(set_search_request, f"stars:<{last_repo_stars}", page)
+        while len(output_lst) < WISHED_LIST_SIZE and last_repo_stars > 0:
             try:
-                should_collect_repo = check_should_collect_repo(repo)
-            except KeyboardInterrupt:
+                repos = next_search.result()['items']
+            except Exception as e:
+                logging.error("Broken", exc_info=True)
+                save_output(output_lst)
                 quit()
+            try:
+                if repos[-1]["stargazers_count"] == last_repo_stars:
+                    page += 1
+                else:
+                    last_repo_stars = repos[-1]["stargazers_count"]
+                    page = 0
             except Exception as e:
-                logging.error(f"!!!!!! skipped {index + 1} {repo['full_name']}", exc_info=True)
-                continue
-            if should_collect_repo:
-                output_lst.append(repo['html_url'])
-                logging.info(
-                    f"repo ({repo['full_name']}) was approved - {len(output_lst)}/{WISHED_LIST_SIZE} done.")
-        try:
-            if repos[-1]["stargazers_count"] == last_repo_stars:
-                page += 1
-            else:
-                last_repo_stars = repos[-1]["stargazers_count"]
-                page = 0
-        except Exception as e:
-            logging.error("Broken", exc_info=True)
-            save_output(output_lst)
-            quit()
+                logging.error("Broken", exc_info=True)
+                save_output(output_lst)
+                quit()
+            # the next page only depends on the last repo of this one, so it's on its way while this one is checked
+            if last_repo_stars > 0:
+                next_search = search_executor.submit(set_search_request, f"stars:<{last_repo_stars}", page)
+
+            # the languages of the whole page in one batch
+            description_languages = classify_languages([repo["description"] or "" for repo in repos])
+            candidates = [repo for repo, description_language in zip(repos, description_languages)
+                          if passes_local_checks(repo, description_language)]
+            repos_metadata = prefetch_repos_metadata(candidates)
+            futures = [check_executor.submit(passes_network_checks, repo, repos_metadata.get(repo["full_name"]), cancelled)
+                       for repo in candidates]
+            # results are taken in search order, so the list still holds the most starred repos that qualify
+            for index, (repo, future) in enumerate(zip(candidates, futures)):
+                try:
+                    should_collect_repo = future.result()
+                except KeyboardInterrupt:
+                    cancelled.set()
+                    quit()
+                except Exception as e:
+                    logging.error(f"!!!!!! skipped {index + 1} {repo['full_name']}", exc_info=True)
+                    continue
+                if should_collect_repo:
+                    output_lst.append(repo['html_url'])
+                    logging.info(
+                        f"repo ({repo['full_name']}) was approved - {len(output_lst)}/{WISHED_LIST_SIZE} done.")
+                if len(output_lst) >= WISHED_LIST_SIZE:
+                    # checks already running stop before their next request, queued ones never start
+                    cancelled.set()
+                    for pending in futures:
+                        pending.cancel()
+                    break
+        next_search.cancel()
 
     save_output(output_lst)
 
@@ -2,15 +2,53 @@ import os
 import multiprocessing as mp
 import shutil
 import logging
+import threading
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
-import pandas as pd
-
-from libs.cloner import BASE_CLONE_LOCATION, clone_repository, delete_currently_cloned_repository
-from libs.class_length import get_class_length_metrics
-from libs.contributors import get_repo_contributors_distribution
+from libs.cloner import BASE_CLONE_LOCATION, SPARSE_CLONE, SNAPSHOT, clone_repository, checkout_repository, \
+    delete_currently_cloned_repository
+from libs.class_length import get_class_length_metrics, get_class_length_metrics_from_mirror
+from libs.contributors import API_CONTRIBUTORS, get_repo_contributors_distribution
+from libs.gate import get_verdict_from_repo, passes_gate, is_current_verdict
+from libs.mirrors import find_local_mirror, update_mirror, release_mirror_lock, enforce_mirrors_quota
+from libs.github_client import create_shared_rate_limiter, delete_shared_rate_limiter, use_rate_limiter
+from libs.instrumentation import start_run, repo_scope, timed, profiled, take_recorded, merge_recorded, \
+    write_run_report
+from libs.pipeline import create_stage, run_pipeline
+from libs.worker_pool import TASK_ERROR, limit_worker_memory, run_worker_pool
+from libs.github_graphql import fetch_repos_metadata
+from libs.checkpoint import COMPLETED, SKIPPED, FAILED, FINISHED_STATUSES, get_repo_name, load_manifest, \
+    reset_checkpoint, open_checkpoint, record_result, close_checkpoint, consolidate_parts
 
 logging.basicConfig(level=logging.INFO, format="%(levelname)s - %(message)s")
 
+CLONE_STRATEGY = SPARSE_CLONE
+USE_MIRRORS = True  # keep bare mirrors between runs and only fetch what changed, instead of clone-and-delete
+# who contributed how much: asked of the api, or counted from the fetched history (which shallow clones and
+# snapshots always fall back to the api for); every row records which one answered in contributors_engine
+CONTRIBUTORS_ENGINE = API_CONTRIBUTORS
+
+POOL_SCHEDULER = "pool"  # one process per repository, running every step of it, under the limits below
+# a separately sized worker pool per step; parse workers are held to WORKER_MEMORY_LIMIT_BYTES but nothing bounds how
+# long one repository takes, so a hung fetch holds up the end of the run
+PIPELINE_SCHEDULER = "pipeline"
+SCHEDULER = POOL_SCHEDULER
+FETCH_WORKERS = 8
+PARSE_WORKERS = mp.cpu_count()
+API_WORKERS = 4
+DELETE_WORKERS = 1
+STAGE_QUEUE_SIZE = 16
+POOL_WORKERS = mp.cpu_count()
+REPO_TIMEOUT_SECONDS = 60 * 60  # a pool worker still on one repository after this long is killed and replaced
+WORKER_MEMORY_LIMIT_BYTES = 4 * 1024 ** 3  # per pool or parse worker, see libs/worker_pool.py; None for no limit
+MAX_REPOS_PER_WORKER = 25  # pool workers are replaced after this many repositories, giving back what they held
+LARGEST_FIRST = True  # start the biggest repositories first, so none of them is left running alone at the end
+PREFETCH_METADATA = True  # one graphql query per GRAPHQL_BATCH_SIZE repositories instead of a rest call each
+RESUME = True  # skip repositories an earlier, interrupted run already finished
+USE_CODE_FILES_GATE = True  # count code files in the fetched tree, and never check out or parse a repo with too few
+
 
 def start_with_clean_sheet():
     if os.path.exists(BASE_CLONE_LOCATION):
@@ -26,42 +64,331 @@ def get_repos_list():
     return repos_url
 
 
+def fetch_repo(repo_url, index):
+    # (location, is_mirror, fetch stats, gate verdict of a repository turned away or None): the gate counts the code
+    # files of what was fetched before any of it is checked out, so a repository it turns away never is
+    with timed("clone"):
+        if USE_MIRRORS:
+            location, fetch_stats = update_mirror(repo_url)
+            is_mirror = True
+        else:
+            location = find_local_mirror(repo_url)
+            is_mirror = location is not None
+            if is_mirror:
+                fetch_stats = {}
+            else:
+                location, fetch_stats = clone_repository(repo_url, CLONE_STRATEGY, checkout=False)
+    verdict = gate_repo(repo_url, index, location, fetch_stats)
+    if verdict is None and not is_mirror:
+        with timed("clone"):
+            checkout_repository(location, fetch_stats)
+    return location, is_mirror, fetch_stats, verdict
+
+
+def gate_repo(repo_url, index, location, fetch_stats):
+    # the verdict of a repository turned away, None for one worth checking out and parsing
+    if not USE_CODE_FILES_GATE or fetch_stats.get("clone_strategy") == SNAPSHOT:
+        return None  # a snapshot holds no tree to count, its scan decides
+    try:
+        with timed("gate"):
+            verdict = get_verdict_from_repo(location, repo_url)
+    except Exception as e:
+        # without a verdict the repository is checked out and its scan decides, as it would without the gate
+        logging.error(f"could not count code files of repository number {index}: {repo_url}")
+        logging.error(e, exc_info=True)
+        return None
+    if passes_gate(verdict):
+        return None
+    logging.info(f"skipped repo number {index} before checking it out")
+    return verdict
+
+
+def measure_repo(repo_url, location, is_mirror):
+    # walking the files is part of it, since files are parsed while the walk goes on
+    with timed("parse"), profiled(repo_url):
+        if is_mirror:
+            # everything is read straight from the mirror's object store
+            return get_class_length_metrics_from_mirror(location)
+        return get_class_length_metrics(location)
+
+
+def measure_repo_in_worker(repo_url, location, is_mirror):
+    # the parse worker's timings and counts travel back with its result
+    with repo_scope(repo_url):
+        class_length_metrics = measure_repo(repo_url, location, is_mirror)
+    return class_length_metrics, take_recorded()
+
+
+def release_repo(location, is_mirror):
+    if not is_mirror:
+        with timed("delete"):
+            delete_currently_cloned_repository(location)
+
+
 def handle_repo(args):
-    repo_url, counter, lock = args
-    with lock:
-        counter.value += 1
-        index = counter.value
+    # the worker's timings and counts travel back with the result
+    with repo_scope(args[1]):
+        repo_url, status, metrics = run_repo(args)
+    return repo_url, status, metrics, take_recorded()
+
+
+def run_repo(args):
+    index, repo_url, repo_metadata = args
     logging.info(f"running repo number {index}")
 
     try:
-        current_clone_location = clone_repository(repo_url)
+        location, is_mirror, fetch_stats, verdict = fetch_repo(repo_url, index)
     except Exception as e:
         logging.error(f"skiping repository number {index} due to clone fail: {repo_url}")
         logging.error(e, exc_info=True)
-        return None
+        return repo_url, FAILED, None
 
     try:
-        class_length_metrics = get_class_length_metrics(current_clone_location)
+        if verdict is not None:
+            return repo_url, SKIPPED, {"gate": verdict}
+
+        class_length_metrics = measure_repo(repo_url, location, is_mirror)
         if class_length_metrics is None:
-            delete_currently_cloned_repository(current_clone_location)
             logging.info(f"skipped repo number {index}")
-            return None
+            return repo_url, SKIPPED, None
 
-        contributors_metrics = get_repo_contributors_distribution(repo_url, current_clone_location)
-        delete_currently_cloned_repository(current_clone_location)
+        contributors_metrics = get_repo_contributors_distribution(repo_url, location, is_mirror, repo_metadata,
+                                                                  CONTRIBUTORS_ENGINE)
+        if not contributors_metrics:
+            logging.info(f"skipped repo number {index}")
+            return repo_url, SKIPPED, None
         logging.info(f"finished repo number {index}")
-        return {**contributors_metrics, **class_length_metrics}
+        return repo_url, COMPLETED, {**contributors_metrics, **class_length_metrics, **fetch_stats}
     except Exception as e:
-        delete_currently_cloned_repository(current_clone_location)
         logging.error(f"skiping repository number {index} due to an error: {repo_url}")
         logging.error(e, exc_info=True)
-        return None
+        return repo_url, FAILED, None
+    finally:
+        release_repo(location, is_mirror)
 
 
-def save_output(all_metrics):
-    df = pd.DataFrame(all_metrics)
-    pathToFile = os.path.join("outputs", "output.parquet")
-    df.to_parquet(pathToFile, index=False)  # or engine="fastparquet"
+def create_item(index, repo_url):
+    return {"index": index, "repo_url": repo_url, "location": None, "is_mirror": False, "status": None,
+            "fetch_stats": None, "class_length_metrics": None, "contributors_metrics": None, "gate": None}
+
+
+def fail_item(item):
+    # an item a stage raised on still goes down the line, so its failure is recorded and its clone deleted
+    if not isinstance(item, dict):
+        item = create_item(*item)
+    logging.error(f"skiping repository number {item['index']} due to an error: {item['repo_url']}")
+    item["status"] = FAILED
+    return item
+
+
+def fail_result(item):
+    return item["repo_url"], FAILED, None
+
+
+def fetch_stage(item):
+    index, repo_url = item
+    logging.info(f"running repo number {index}")
+    item = create_item(index, repo_url)
+    with repo_scope(repo_url):
+        try:
+            item["location"], item["is_mirror"], item["fetch_stats"], item["gate"] = fetch_repo(repo_url, index)
+        except Exception as e:
+            logging.error(f"skiping repository number {index} due to clone fail: {repo_url}")
+            logging.error(e, exc_info=True)
+            item["status"] = FAILED
+            return item
+        if item["gate"] is not None:
+            item["status"] = SKIPPED
+    return item
+
+
+def create_parse_pool():
+    # parse workers are spawned, not forked - a fork taken while a fetch thread is starting git inherits
+    # that thread's exec pipe and leaves it waiting forever
+    return {"executor": ProcessPoolExecutor(PARSE_WORKERS, mp_context=mp.get_context("spawn"),
+                                            initializer=limit_worker_memory, initargs=(WORKER_MEMORY_LIMIT_BYTES,)),
+            "lock": threading.Lock()}
+
+
+def parse_in_pool(parse_pool, repo_url, location, is_mirror):
+    executor = parse_pool["executor"]
+    try:
+        return executor.submit(measure_repo_in_worker, repo_url, location, is_mirror).result()
+    except BrokenProcessPool:
+        # a parse worker that died (out of memory, a crash) takes the executor down with it, failing every parse
+        # then running; the next ones get a new executor instead of failing too
+        with parse_pool["lock"]:
+            if parse_pool["executor"] is executor:
+                executor.shutdown(wait=False)
+                parse_pool["executor"] = create_parse_pool()["executor"]
+        raise
+
+
+def parse_stage(item, parse_pool):
+    if item["status"] is not None:
+        return item
+    try:
+        item["class_length_metrics"], worker_recorded = parse_in_pool(parse_pool, item["repo_url"], item["location"],
+                                                                      item["is_mirror"])
+        merge_recorded(worker_recorded)
+    except Exception as e:
+        logging.error(f"skiping repository number {item['index']} due to an error: {item['repo_url']}")
+        logging.error(e, exc_info=True)
+        item["status"] = FAILED
+        return item
+    if item["class_length_metrics"] is None:
+        logging.info(f"skipped repo number {item['index']}")
+        item["status"] = SKIPPED
+    return item
+
+
+def api_stage(item, repos_metadata):
+    if item["status"] is not None:
+        return item
+    try:
+        with repo_scope(item["repo_url"]):
+            item["contributors_metrics"] = get_repo_contributors_distribution(
+                item["repo_url"], item["location"], item["is_mirror"],
+                repos_metadata.get(get_repo_name(item["repo_url"])), CONTRIBUTORS_ENGINE)
+    except Exception as e:
+        logging.error(f"skiping repository number {item['index']} due to an error: {item['repo_url']}")
+        logging.error(e, exc_info=True)
+        item["status"] = FAILED
+        return item
+    if not item["contributors_metrics"]:
+        logging.info(f"skipped repo number {item['index']}")
+        item["status"] = SKIPPED
+    return item
+
+
+def delete_stage(item):
+    if item["location"] is not None:
+        try:
+            with repo_scope(item["repo_url"]):
+                release_repo(item["location"], item["is_mirror"])
+        except Exception as e:
+            # whatever is left behind goes with the leftovers at the end of the run
+            logging.error(f"could not delete clone of repository number {item['index']}: {item['repo_url']}")
+            logging.error(e, exc_info=True)
+    if item["status"] is not None:
+        return item["repo_url"], item["status"], {"gate": item["gate"]} if item["gate"] is not None else None
+    logging.info(f"finished repo number {item['index']}")
+    return item["repo_url"], COMPLETED, {**item["contributors_metrics"], **item["class_length_metrics"],
+                                         **item["fetch_stats"]}
+
+
+def scan_with_pool(repos_url, repos_metadata, on_result):
+    # repositories go out one at a time to whichever worker is free, numbered as they're handed out
+    def on_repo_result(args, result):
+        repo_url, status, metrics, worker_recorded = result
+        merge_recorded(worker_recorded)
+        on_result((repo_url, status, metrics))
+
+    def on_repo_failure(args, reason, worker_pid):
+        index, repo_url, _ = args
+        logging.error(f"skiping repository number {index} due to {reason.replace('_', ' ')}: {repo_url}")
+        if USE_MIRRORS and reason != TASK_ERROR:
+            # a worker killed mid-fetch never got to release the mirror's lock
+            release_mirror_lock(repo_url, worker_pid)
+        on_result((repo_url, FAILED, {"failure": reason}))
+
+    # every worker draws from the same rate-limit budget instead of each sleeping out the limit on its own
+    rate_limiter = create_shared_rate_limiter(mp.get_context("spawn"))
+    try:
+        run_worker_pool([(index, repo_url, repos_metadata.get(get_repo_name(repo_url)))
+                         for index, repo_url in enumerate(repos_url, start=1)],
+                        handle_repo, on_repo_result, on_repo_failure, POOL_WORKERS,
+                        task_timeout=REPO_TIMEOUT_SECONDS, memory_limit=WORKER_MEMORY_LIMIT_BYTES,
+                        max_tasks_per_worker=MAX_REPOS_PER_WORKER, initializer=use_rate_limiter,
+                        initargs=(rate_limiter,))
+    finally:
+        delete_shared_rate_limiter(rate_limiter)
+
+
+def scan_with_pipeline(repos_url, repos_metadata, on_result):
+    # network-bound stages run on threads and only parsing takes a process, so waiting never holds a cpu slot
+    parse_pool = create_parse_pool()
+    try:
+        stages = [
+            create_stage("fetch", fetch_stage, FETCH_WORKERS, STAGE_QUEUE_SIZE, fail_item),
+            create_stage("parse", partial(parse_stage, parse_pool=parse_pool), PARSE_WORKERS, STAGE_QUEUE_SIZE,
+                         fail_item),
+            create_stage("api", partial(api_stage, repos_metadata=repos_metadata), API_WORKERS, STAGE_QUEUE_SIZE,
+                         fail_item),
+            create_stage("delete", delete_stage, DELETE_WORKERS, STAGE_QUEUE_SIZE, fail_result),
+        ]
+        run_pipeline(enumerate(repos_url, start=1), stages, on_result)
+    finally:
+        parse_pool["executor"].shutdown()
+
+
+def is_finished(entry):
+    # a gate verdict only stands while the gate asks the same question
+    if entry["status"] not in FINISHED_STATUSES:
+        return False
+    return "gate" not in entry or (USE_CODE_FILES_GATE and is_current_verdict(entry["gate"]))
+
+
+def get_pending_repos(repos_url):
+    manifest = load_manifest()
+    pending_repos = [repo_url for repo_url in repos_url
+                     if repo_url not in manifest or not is_finished(manifest[repo_url])]
+    if len(pending_repos) < len(repos_url):
+        logging.info(f"resuming: {len(repos_url) - len(pending_repos)} repositories already done in earlier runs")
+    return pending_repos
+
+
+def prefetch_repos_metadata(repos_url):
+    if not PREFETCH_METADATA:
+        return {}
+    try:
+        with timed("metadata_graphql"):
+            return fetch_repos_metadata([get_repo_name(repo_url) for repo_url in repos_url])
+    except Exception as e:
+        # every repository falls back to its own rest call
+        logging.error("could not prefetch repositories metadata", exc_info=True)
+        return {}
+
+
+def order_largest_first(repos_url, repos_metadata):
+    # repositories of unknown size go first, they may well be the biggest
+    def get_size(repo_url):
+        size = (repos_metadata.get(get_repo_name(repo_url)) or {}).get("disk_usage_kb")
+        return float("inf") if size is None else size
+
+    return sorted(repos_url, key=get_size, reverse=True)
+
+
+def scan_repos(repos_url):
+    checkpoint = open_checkpoint()
+    clone_summary = {"repos": 0, "clone_seconds": 0, "clone_bytes": 0}
+
+    def on_result(result):
+        repo_url, status, metrics = result
+        record_result(checkpoint, repo_url, status, metrics)
+        if metrics is not None and "clone_seconds" in metrics:
+            clone_summary["repos"] += 1
+            clone_summary["clone_seconds"] += metrics["clone_seconds"]
+            clone_summary["clone_bytes"] += metrics["clone_bytes"]
+
+    repos_metadata = prefetch_repos_metadata(repos_url)
+    if LARGEST_FIRST:
+        repos_url = order_largest_first(repos_url, repos_metadata)
+    try:
+        if SCHEDULER == PIPELINE_SCHEDULER:
+            scan_with_pipeline(repos_url, repos_metadata, on_result)
+        else:
+            scan_with_pool(repos_url, repos_metadata, on_result)
+    finally:
+        # whatever finished before an interruption is kept for the next run
+        close_checkpoint(checkpoint)
+    return clone_summary
+
+
+def log_clone_summary(clone_summary):
+    strategy = "mirror" if USE_MIRRORS else CLONE_STRATEGY
+    logging.info(f"{strategy} clones of {clone_summary['repos']} repositories: {clone_summary['clone_seconds']:.0f}s, "
+                 f"{clone_summary['clone_bytes'] / (1024 ** 3):.2f} GB transferred")
 
 
 def delete_leftovers():
@@ -71,21 +398,21 @@ def delete_leftovers():
 def main_scan_repos():
     GITHUB_TOKEN = os.environ["GITHUB_TOKEN"]
     if GITHUB_TOKEN:
+        start_run("scan")
         start_with_clean_sheet()
-        repos_url = get_repos_list()
-        
-        with mp.Manager() as manager:
-            counter = manager.Value('i', 0)
-            lock = manager.Lock()
-
-            with mp.Pool(mp.cpu_count()) as pool:
-                metrics_metadata_results = pool.map_async(handle_repo,
-                      [(repo_url, counter, lock) for repo_url in repos_url]).get()
-                pool.close()
-                pool.join()
-
-        save_output([item for item in metrics_metadata_results if item is not None])
+        if USE_MIRRORS:
+            enforce_mirrors_quota()
+        if not RESUME:
+            reset_checkpoint()
+        repos_url = get_pending_repos(get_repos_list())
+
+        clone_summary = scan_repos(repos_url)
+        log_clone_summary(clone_summary)
+        consolidate_parts()
         delete_leftovers()
+        if USE_MIRRORS:
+            enforce_mirrors_quota()
+        write_run_report({"clone_summary": clone_summary})
     else:
         logging.error("GITHUB_TOKEN must be supplied as environment variable")
         quit()